@@ -1,8 +1,15 @@
 from itertools import chain
 from fabric.api import env, local, task, runs_once
 from fabric.colors import green,blue,cyan,yellow,magenta,red
+from functools import wraps
+from Queue import Empty, Queue
+import hashlib
+import json
+import os
+import random
 import subprocess
 import sys
+import threading
 import time
 
 # -------------- Logging helpers ------------------
@@ -24,6 +31,19 @@ def merge_dicts(*dicts):
     "Merge dictionaries, with later ones overriding earlier ones. From http://stackoverflow.com/a/38990/708883"
     return dict(chain(*[d.iteritems() for d in dicts]))
 
+def fingerprint(*inputs):
+    "Returns a stable hex digest of the provided JSON-serializable inputs. Dict key order does not matter."
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+def cache_directory(*parts):
+    """Returns (creating if needed) a directory for fabulous' files on the control machine, under $XDG_CACHE_HOME or
+    ~/.cache unless env.fabulous_cache_dir is set."""
+    root = env.get('fabulous_cache_dir') or os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'fabulous')
+    path = os.path.join(root, *parts)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
 
 
 
@@ -43,9 +63,85 @@ def run_and_return_result(args,assert_successful=False):
 
 
 
+# -------------- Concurrency helpers ------------------
+
+def concurrently(f, items, pool_size=None):
+    """Calls f(item) for each item using a bounded pool of threads.
+    Returns list of (item, result, exception) tuples in the same order as items; exception is None on success.
+    Intended for blocking network calls (SSH handshakes, provider APIs). Do not use for Fabric operations
+    that depend on env.host_string, as env is shared between threads."""
+    items = list(items)
+    results = [None] * len(items)
+    work = Queue()
+    for i, item in enumerate(items):
+        work.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = work.get_nowait()
+            except Empty:
+                return
+            try:
+                results[i] = (item, f(item), None)
+            except (Exception, SystemExit), e:
+                # Fabric's abort and some providers signal failure with SystemExit; report it like any other failure
+                results[i] = (item, None, e)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(pool_size or len(items), len(items))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+class Future(object):
+    "Result of a call started by submit(), available once the call completes."
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Blocks until the call completes (or timeout seconds pass, raising RuntimeError), then returns its result or
+        re-raises its exception with the original traceback."""
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out after %ss waiting for result" % timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+def submit(f, *args, **kwargs):
+    """Starts f(*args, **kwargs) on a thread of its own and returns a Future for its result, so that independent
+    blocking calls (e.g. provider APIs) can overlap. Same caveat as concurrently(): not for Fabric operations that
+    depend on env.host_string."""
+    future = Future()
+    def call():
+        try:
+            future._result = f(*args, **kwargs)
+        except (Exception, SystemExit):
+            # Fabric and some providers signal failure with SystemExit; hand it to whoever waits on the result
+            future._exc_info = sys.exc_info()
+        future._done.set()
+    thread = threading.Thread(target=call)
+    thread.daemon = True
+    thread.start()
+    return future
+
+def gather(*futures):
+    "Waits for all futures, returning their results in order. The first failure (in that order) is raised."
+    return [future.result() for future in futures]
+
+
+
+
 # -------------- Error helpers ------------------
 
-def retry(ExceptionToCheck, total_tries=4, initial_delay_seconds=3, backoff_multiplier=2, handler=None):
+def retry(ExceptionToCheck, total_tries=4, initial_delay_seconds=3, backoff_multiplier=2, handler=None, jitter=False, deadline_seconds=None):
     """Retry calling the decorated function using an exponential back-off.
 
     adapted from: http://www.saltycrane.com/blog/2009/11/trying-out-retry-decorator-python/
@@ -56,6 +152,11 @@ def retry(ExceptionToCheck, total_tries=4, initial_delay_seconds=3, backoff_mult
 
     :param handler: If operation is never successful, final exception is raised unless a handler is provided, in which case it is invoked with the exception._log_
 
+    :param jitter: If True, sleep a random time of up to the current delay instead ("full jitter"), so that many
+        callers failing at once (e.g. parallel hosts hitting a provider's rate limit) do not retry in lockstep.
+
+    :param deadline_seconds: If provided, give up once retrying would go past this many seconds since the first try.
+
     Usage:
         @retry(ExceptionToCheck)
         def my_function(arg1, arg2):
@@ -66,17 +167,23 @@ def retry(ExceptionToCheck, total_tries=4, initial_delay_seconds=3, backoff_mult
     initial_delay_seconds * backoff_multiplier ^ (total_tries - 1) - initial_delay_seconds
     """
     def deco_retry(f):
+        @wraps(f)
         def f_retry(*args, **kwargs):
             mtries_remaining, mdelay = total_tries, initial_delay_seconds
+            deadline = time.time() + deadline_seconds if deadline_seconds else None
             while mtries_remaining > 0:
                 try:
                     return f(*args, **kwargs)
                 except ExceptionToCheck, e:
                     lastException = e
                     mtries_remaining -= 1
+                    sleep = random.uniform(0, mdelay) if jitter else mdelay
+                    if deadline and time.time() + sleep > deadline:
+                        warn("%s: %s, Giving up as deadline of %d seconds has passed." % (type(e).__name__,str(e), deadline_seconds))
+                        break
                     if mtries_remaining > 0:
-                        info("%s invocation failed (%s: %s). Don't panic yet; retrying in %d seconds..." % (f.__name__,type(e).__name__, str(e), mdelay))
-                        time.sleep(mdelay)
+                        info("%s invocation failed (%s: %s). Don't panic yet; retrying in %d seconds..." % (f.__name__,type(e).__name__, str(e), sleep))
+                        time.sleep(sleep)
                         mdelay *= backoff_multiplier
                     else:
                         warn("%s: %s, Giving up after %d attempts." % (type(e).__name__,str(e), total_tries))
@@ -0,0 +1,40 @@
+"""
+Identity of the artifact being deployed: the Git SHA of the working directory plus a content digest of the build output.
+Both are computed once per run and memoized, so looping over hosts (e.g. record_deployment per host) costs nothing extra.
+The digest is what stageflip stamps into each active directory to tell whether a host already runs this exact build.
+"""
+from . import debug, git
+from os import path
+import hashlib
+import os
+
+_digests_ = {} # build path -> content digest
+
+def digest_of(build_path):
+    """Returns a sha256 content digest of the file or directory tree at build_path. Covers relative paths, contents and
+    executable bits of all files, so it changes whenever anything that would be uploaded changes. Memoized per run."""
+    build_path = path.abspath(build_path)
+    if build_path not in _digests_:
+        digest = hashlib.sha256()
+        for relative_path in _files_(build_path):
+            full_path = path.join(build_path, relative_path) if relative_path else build_path
+            digest.update("%s\0%d\0" % (relative_path, os.stat(full_path).st_mode & 0111))
+            with open(full_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), ''):
+                    digest.update(block)
+        _digests_[build_path] = digest.hexdigest()
+        debug("Artifact %s has digest %s" % (build_path, _digests_[build_path]))
+    return _digests_[build_path]
+
+def _files_(build_path):
+    if path.isfile(build_path):
+        return ['']
+    files = []
+    for root, dirs, names in os.walk(build_path):
+        dirs.sort()
+        files += [path.relpath(path.join(root, name), build_path) for name in sorted(names)]
+    return files
+
+def identity(build_path):
+    """Returns dict with the Git SHA ('sha') and content digest ('digest') of the artifact at build_path."""
+    return {'sha': git.get_sha(), 'digest': digest_of(build_path)}
@@ -1,16 +1,22 @@
 from collections import defaultdict
 from fabric.api import env, execute, run, task
-from fabulous import debug,error,info,warn,retry,run_and_return_result
+from fabulous import debug,error,info,warn,retry,run_and_return_result,submit
 from fabulous.config import configure
 from paramiko import SSHException
+from . import inventory
 import re
+import time
 
 def show(nodes = None):
     """Pretty-prints table of provided nodes, or env.nodes otherwise."""
     nodes = env.nodes if nodes is None else nodes # Explicit None check because [] is False
     if (len(nodes) > 0):
-        print ("<node id> (<node name> @ <ip address>)")
-        print(pretty_instances(nodes, "\n"))
+        if any([version_of(node) for node in nodes]):
+            print ("<node id> (<node name> @ <ip address>) <git sha> <artifact digest> <deployed at>")
+            print("\n".join(["%s %s" % (pretty_instance(node), pretty_version(node)) for node in nodes]))
+        else:
+            print ("<node id> (<node name> @ <ip address>)")
+            print(pretty_instances(nodes, "\n"))
     else:
         print("<no nodes>")
     print("")
@@ -25,11 +31,11 @@ def use(node):
     "Add the node to the fabric environment"
     try:
         role = node.tags.get("Name").split('-')[1]
-        env.roledefs[role] += [ip_address(node)]
+        env.roledefs[role] += [host_string(node)]
     except IndexError:
         pass
     env.nodes += [node]
-    env.hosts += [ip_address(node)]
+    env.hosts += [host_string(node)]
 
 def use_only(*nodes):
     "Reverts any prior use(node) invocations and uses the specified nodes."
@@ -43,11 +49,11 @@ def unuse(node):
     "Remove specified node from the fabric environment; undoes use(node) from Cloth utils.py."
     try:
         role = role_of(node)
-        env.roledefs[role] = [ip_address for ip_address in env.roledefs[role] if ip_address != ip_address(node)]
+        env.roledefs[role] = [host for host in env.roledefs[role] if host != host_string(node)]
     except IndexError:
         pass
     env.nodes = [other_node for other_node in env.nodes if other_node != node]
-    env.hosts = [ip_address for ip_address in env.hosts if ip_address != ip_address(node)]
+    env.hosts = [host for host in env.hosts if host != host_string(node)]
 
 def current_node():
     for node in env.nodes:
@@ -97,7 +103,43 @@ def pretty_instances(nodes, joinWith=", "):
 # Adapted from https://github.com/garethr/cloth/blob/master/src/cloth/utils.py to support Google Compute Engine as well
 
 def instances():
-    return [node for node in env.provider_instance_function() if node.tags and ip_address(node)]
+    return [node for node in provider_instances() if node.tags and ip_address(node)]
+
+def provider_instances():
+    """All instances the provider reports. Served from the on-disk inventory cache once use_inventory_cache() has been
+    called in this run (and the cache is enabled), otherwise fetched from the provider."""
+    if env.get('inventory_cache_in_use'):
+        return inventory.cached_instances()
+    return env.provider_instance_function()
+
+def use_inventory_cache():
+    """Serve instance lookups for the rest of this run from the on-disk inventory cache, if inventory_cache is enabled.
+    Intended for read-only tasks; see fabulous.cloud.inventory."""
+    env.inventory_cache_in_use = inventory.is_enabled()
+
+def instances_with_ids(ids):
+    """Returns those of the instances with the given ids the provider still knows about, fetched from the provider."""
+    if 'provider_instances_by_id_function' in env:
+        return env.provider_instances_by_id_function(ids)
+    return [node for node in env.provider_instance_function() if node.id in ids]
+
+def fresh_nodes(nodes):
+    """Returns the provider's own instance objects for nodes, re-fetching any served from the inventory cache, so that
+    tasks which go on to change them (decommission, load balancer membership, ...) work with what the provider API
+    expects. Nodes that no longer exist are dropped."""
+    cached_ids = [node.id for node in nodes if isinstance(node, inventory.CachedInstance)]
+    if not cached_ids:
+        return nodes
+    fetched = dict([(node.id, node) for node in instances_with_ids(cached_ids)])
+    result = []
+    for node in nodes:
+        if node.id not in cached_ids:
+            result.append(node)
+        elif node.id in fetched:
+            result.append(fetched[node.id])
+        else:
+            warn("Node %s is no longer known to the provider; leaving it out." % node.id)
+    return result
 
 
 def instances_with_name(exp=".*"):
@@ -138,14 +180,35 @@ def provider_config(provider_config_function):
     return False
 
 ## ------------------ Cluster management -----------------------
-def provision_nodes(num, next_id):
+def provision_nodes(num, next_id, stages = None, on_node_ready = None, on_event = None):
+    """Provisions num nodes and takes each one independently through SSH readiness, the provider's post-provision hook
+    and any caller-supplied stages (see pipeline.py for the stages and callbacks).
+    Returns the nodes that completed every stage; these are also use()'d."""
+    from .pipeline import run_pipeline
     info("Provisioning %d new node(s)" % (num))
-    nodes = env.provider_provision_function(num, next_id)
-    use_only(*nodes)
-    wait_for_ssh_access()
-    if 'provider_post_provision_hook' in env:
-        env.provider_post_provision_hook()
+    nodes = run_pipeline(num, next_id, stages, on_event, on_node_ready)
+    inventory.invalidate()
+    return nodes
+
+def resume_provisioning(stages = None, on_node_ready = None, on_event = None):
+    """Continues the interrupted provision_nodes run for env.platform and env.role from its checkpoint journal (see
+    journal.py), adopting the nodes it launched. Returns the nodes that completed every stage, or None if there is no
+    run to resume."""
+    from . import journal
+    from .pipeline import run_pipeline
+    checkpoints = journal.load()
+    if not checkpoints:
+        return None
+    info("Resuming provisioning of %d node(s) interrupted at %s" % (checkpoints['num'], time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(checkpoints['started']))))
+    nodes = run_pipeline(checkpoints['num'], checkpoints['next_id'], stages, on_event, on_node_ready, resume=checkpoints)
+    inventory.invalidate()
+    return nodes
 
+def bootstrap_required():
+    """Returns False if the most recently provisioned nodes were launched from a baked image (see aws.bake_image), so
+    fabfiles can skip bootstrap steps the image already covers (upgrade_system, install_packages, installing the
+    Datadog agent). Per-node steps such as add_datadog_agent_tags must still run."""
+    return not env.get('provisioned_from_baked_image')
 
 # EC2 reports instance state as 'running' before SSH access is available.
 # Delay here so downstream tasks can assume all nodes are available.
@@ -154,6 +217,9 @@ def provision_nodes(num, next_id):
 @retry(SystemExit, total_tries=8)
 @retry(SSHException, total_tries=8)
 def wait_for_ssh_access():
+    from .ssh import prewarm
+    # Open all sessions concurrently; connect then verifies each host over its now-cached session.
+    prewarm()
     execute(connect)
     info("All nodes are now online. %s (%s)" % (env.hosts, env.nodes))
 
@@ -166,6 +232,7 @@ def decommission_nodes():
     "Stop instances"
     info("Decommissioning node(s) %s." % pretty_instances(env.nodes))
     env.provider_decommission_function()
+    inventory.invalidate()
 
 def virtual_ip_specified():
     """Returns True if a virtual IP address has been specified."""
@@ -198,6 +265,128 @@ def lb_remove_nodes():
     """Removes the currently use()'d nodes from the load balancer."""
     env.provider_load_balancer_remove_nodes_function()
 
+## ------------------ Asynchronous provider interface -----------------------
+# Each function below starts a provider call and returns a fabulous.Future for its result, so independent calls (e.g.
+# enumerating instances while fetching load balancer members) cost the slowest of them rather than their sum.
+# A provider may supply its own non-blocking version of a hook as env.provider_<hook>_async_function, taking the same
+# arguments and returning a Future; otherwise the blocking hook runs on a thread of its own. The blocking functions
+# above remain the synchronous interface. As env.nodes is shared, hooks acting on nodes are passed them explicitly
+# (nodes=...), which the decommission and load balancer add / remove hooks must accept for these to be used. Nobody can
+# answer a prompt from such a thread, so the decommission hook is also passed interactive=False.
+
+def provider_async(hook, *args, **kwargs):
+    """Starts env.provider_<hook>_function(*args, **kwargs), e.g. provider_async('load_balancer_membership').
+    Returns a Future."""
+    async_function = env.get('provider_%s_async_function' % hook)
+    if async_function:
+        return async_function(*args, **kwargs)
+    return submit(env['provider_%s_function' % hook], *args, **kwargs)
+
+def instances_async():
+    """Future for instances()."""
+    return submit(instances)
+
+def lb_get_nodes_async():
+    """Future for lb_get_nodes()."""
+    return provider_async('load_balancer_membership')
+
+def virtual_ip_get_node_async():
+    """Future for virtual_ip_get_node()."""
+    return provider_async('virtual_ip_membership')
+
+def live_nodes_async():
+    """Future for the nodes serving traffic: those behind the load balancer, the one holding the virtual IP (if any),
+    or None if neither is specified."""
+    if lb_specified():
+        return lb_get_nodes_async()
+    if virtual_ip_specified():
+        node_future = virtual_ip_get_node_async()
+        return submit(lambda: [node for node in [node_future.result()] if node])
+    return submit(lambda: None)
+
+def lb_add_nodes_async(nodes):
+    """Future for adding nodes to the load balancer."""
+    return provider_async('load_balancer_add_nodes', nodes=nodes)
+
+def lb_remove_nodes_async(nodes):
+    """Future for removing nodes from the load balancer."""
+    return provider_async('load_balancer_remove_nodes', nodes=nodes)
+
+def decommission_nodes_async(nodes):
+    """Future for decommissioning nodes. The inventory cache is invalidated once they are gone. Never prompts, as it
+    runs on a thread of its own: where the provider would ask before going ahead, the future fails instead."""
+    info("Decommissioning node(s) %s." % pretty_instances(nodes))
+    future = provider_async('decommission', nodes=nodes, interactive=False)
+    def decommissioned():
+        try:
+            return future.result()
+        finally:
+            inventory.invalidate()
+    return submit(decommissioned)
+
+## ------------------ Provisioning progress -----------------------
+# Nodes being taken through the provisioning pipeline are tagged as such until they have completed every stage, so
+# that other runs (e.g. the rolling strategy's reconcile task) leave them alone. Nodes without the tag predate it.
+PROVISIONING_TAG = 'fabulous:provisioning'
+PROVISIONING_IN_PROGRESS, PROVISIONING_DONE, PROVISIONING_FAILED = ['in-progress', 'done', 'failed']
+
+# Freshly launched instances are not always visible to the tagging API straight away
+@retry(Exception, total_tries=4, initial_delay_seconds=2, handler=lambda e: warn("Could not record provisioning status: %s" % e))
+def mark_provisioning(nodes, status):
+    """Records provisioning status of nodes with one provider call, if the provider supports tagging."""
+    if nodes and 'provider_tag_nodes_function' in env:
+        tag_nodes(nodes, {PROVISIONING_TAG: status})
+
+def provisioning_failed(node):
+    return (node.tags or {}).get(PROVISIONING_TAG) == PROVISIONING_FAILED
+
+def is_provisioned(node):
+    """Returns False while node is being provisioned, or if provisioning it failed."""
+    return (node.tags or {}).get(PROVISIONING_TAG) in (None, '', PROVISIONING_DONE)
+
+## ------------------ Deployed versions -----------------------
+# Deploys can record what they deployed as tags on the instances themselves (one batched provider call), so the
+# inventory alone answers which node runs which version.
+GIT_SHA_TAG, ARTIFACT_DIGEST_TAG, DEPLOYED_AT_TAG = ['fabulous:git-sha', 'fabulous:artifact-digest', 'fabulous:deployed-at']
+
+def tag_deployed_version(nodes = None, sha = None, digest = None):
+    """Tags nodes (default env.nodes) with the deployed Git SHA, artifact digest and deploy time, in one provider call."""
+    nodes = env.nodes if nodes is None else nodes # Explicit None check because [] is False
+    if not nodes:
+        return
+    if not 'provider_tag_nodes_function' in env:
+        warn("Provider does not support tagging nodes; deployed version not recorded on %s." % pretty_instances(nodes))
+        return
+    tags = {DEPLOYED_AT_TAG: time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+    if sha:
+        tags[GIT_SHA_TAG] = sha
+    if digest:
+        tags[ARTIFACT_DIGEST_TAG] = digest
+    info("Recording deployed version %s on %d node(s)." % (pretty_version(tags=tags), len(nodes)))
+    tag_nodes(nodes, tags)
+
+def tag_nodes(nodes, tags):
+    """Applies tags (dict) to nodes with a single provider call, and to the node objects and inventory cache."""
+    env.provider_tag_nodes_function(nodes, tags)
+    for node in nodes:
+        node.tags.update(tags)
+    inventory.store(nodes)
+
+def version_of(node):
+    """Returns dict with the 'sha', 'digest' and 'deployed_at' recorded on node, or None if none recorded."""
+    if not node.tags or not (node.tags.get(GIT_SHA_TAG) or node.tags.get(ARTIFACT_DIGEST_TAG)):
+        return None
+    return {'sha': node.tags.get(GIT_SHA_TAG), 'digest': node.tags.get(ARTIFACT_DIGEST_TAG), 'deployed_at': node.tags.get(DEPLOYED_AT_TAG)}
+
+def pretty_version(node = None, tags = None):
+    tags = tags if tags is not None else node.tags
+    return "%s %s %s" % ((tags.get(GIT_SHA_TAG) or "-")[:12], (tags.get(ARTIFACT_DIGEST_TAG) or "-")[:12], tags.get(DEPLOYED_AT_TAG) or "-")
+
+def with_version(nodes, version):
+    """Returns those nodes whose recorded Git SHA or artifact digest starts with version (e.g. an abbreviated SHA)."""
+    return [node for node in nodes if version_of(node) and
+            any([value and value.startswith(version) for value in (version_of(node)['sha'], version_of(node)['digest'])])]
+
 ## ------------------ Node utilities -----------------------
 def ip_address(node):
     "Return public IP address of node, if any, otherwise private IP address"
@@ -206,3 +395,9 @@ def ip_address(node):
     else:
         return node.private_ip_address
 
+def host_string(node):
+    "Return the Fabric host string used to reach node. Includes the SSH user if it is provider-specific (see hybrid.py)."
+    registry = env.get('provider_registry') or {}
+    user = registry.get(getattr(node, 'provider', None), {}).get('user')
+    return "%s@%s" % (user, ip_address(node)) if user else ip_address(node)
+
@@ -1,17 +1,24 @@
 from boto import ec2
 from boto.ec2 import elb
+from boto.ec2.tag import Tag
 from boto.exception import BotoServerError
 from fabric.api import env, execute, run, sudo
 from fabric.colors import green
 from fabric.contrib.console import confirm
 from fabric.contrib.files import append,sed
-from . import ip_address, pretty_instance, show
-from .. import debug, error, info, warn
+from . import governor, ip_address, journal, pretty_instance, pretty_instances, provider_instances, show
+from .governor import GovernedConnection
+from .. import concurrently, debug, error, fingerprint, info, retry, submit, warn
 from ..config import verify_env_contains_keys
+from ..state import applied_step
 import os
 import random
 import tempfile
 import time
+import uuid
+
+DEFAULT_LAUNCH_CHUNK_SIZE = 50
+DEFAULT_LAUNCH_CONCURRENCY = 4
 
 def is_ec2():
     return "provider" in env and env.provider == "ec2"
@@ -46,8 +53,14 @@ def aws_config():
         env.aws_ec2_security_group_ids = [env.aws_ec2_security_group_id] if 'aws_ec2_security_group_id' in env else None
         env.user=env['ec2_ami_user'] # Force SSH via the configured user for our AMI rather than local user identified by $USER
         env.provider_instance_function = _ec2_instances_
+        env.provider_instance_states_function = _ec2_instance_states_
+        env.provider_instance_tags_function = _ec2_instance_tags_
+        env.provider_instances_by_id_function = _ec2_instances_with_ids_
+        env.provider_instances_by_client_token_function = _ec2_instances_with_client_tokens_
         env.provider_decommission_function = _decommission_ec2_nodes_
         env.provider_provision_function = _provision_ec2_nodes_
+        env.provider_launch_function = _launch_ec2_nodes_for_provisioning_
+        env.provider_poll_provisioning_function = _poll_ec2_provisioning_
         env.provider_virtual_ip_is_specified_function = _is_virtual_ip_specified_
         env.provider_virtual_ip_membership_function = _get_virtual_ip_node_
         env.provider_virtual_ip_assign_function = _assign_virtual_ip_
@@ -55,8 +68,9 @@ def aws_config():
         env.provider_load_balancer_membership_function = _enumerate_elb_members_
         env.provider_load_balancer_add_nodes_function = _assign_to_elb_
         env.provider_load_balancer_remove_nodes_function = _unassign_from_elb_
+        env.provider_tag_nodes_function = _tag_ec2_nodes_
         # By default, assume /etc/hosts needs munging if in VPC
-        munge_by_default = 'aws_ec2_subnet_id' in env
+        munge_by_default = 'aws_ec2_subnet_id' in env or 'aws_ec2_subnet_ids' in env
         if ('aws_ec2_munge_etc_hosts' in env and env.aws_ec2_munge_etc_hosts) or munge_by_default:
             env.provider_post_provision_hook = _munge_etc_hosts_
         debug("AWS access configured. EC2 SSH as %s using key %s" % (env.user, env.key_filename[0] if env.key_filename else "<to be created>"))
@@ -66,24 +80,23 @@ def aws_config():
 
 def connect(region = None):
     """Return a boto EC2Connection using credentials specified in env. Connects to env.aws_ec2_region unless otherwise specified.
-    Use directly for AWS-specific tweaking not supported by other fabulous functionality."""
+    Use directly for AWS-specific tweaking not supported by other fabulous functionality.
+    Calls made through it are rate-governed (see governor.py); calls made by objects it returns are not, unless wrapped
+    with governor.call."""
     region = region or env.aws_ec2_region
-    return ec2.connect_to_region(region, aws_access_key_id=env.aws_access_key_id, aws_secret_access_key=env.aws_secret_access_key)
+    return GovernedConnection(ec2.connect_to_region(region, aws_access_key_id=env.aws_access_key_id, aws_secret_access_key=env.aws_secret_access_key),
+                              governor.EC2_DESCRIBE, governor.EC2_MUTATE)
 
 def connect_elb(region = None):
     """Return a boto ELBConnection using credentials specified in env.  Connects to env.aws_ec2_region unless otherwise specified.
     Use directly for AWS-specific tweaking not supported by other fabulous functionality."""
     region = region or env.aws_ec2_region
-    return elb.connect_to_region(region, aws_access_key_id=env.aws_access_key_id, aws_secret_access_key=env.aws_secret_access_key)
+    return GovernedConnection(elb.connect_to_region(region, aws_access_key_id=env.aws_access_key_id, aws_secret_access_key=env.aws_secret_access_key),
+                              governor.ELB)
 
 def _ec2_instances_by_id():
-    "Use the EC2 API to get a list of all machines, return dict keyed by id."
-    reservations = connect().get_all_instances()
-    instances = {}
-    for reservation in reservations:
-        for instance in reservation.instances:
-            instances[instance.id] = instance
-    return instances
+    "Use the EC2 API (or the inventory cache, if in use) to get a list of all machines, return dict keyed by id."
+    return dict([(instance.id, instance) for instance in provider_instances()])
 
 # Adapted from https://github.com/garethr/cloth/blob/master/src/cloth/utils.py
 def _ec2_instances_():
@@ -94,6 +107,51 @@ def _ec2_instances_():
         instances += reservation.instances
     return instances
 
+def _ec2_instance_states_():
+    "Use the EC2 instance status API to cheaply get dict of instance id -> state for all machines (see inventory.py)"
+    states = {}
+    next_token = None
+    while True:
+        statuses = connect().get_all_instance_status(include_all_instances=True, max_results=1000, next_token=next_token)
+        for status in statuses:
+            states[status.id] = status.state_name
+        next_token = statuses.next_token
+        if not next_token:
+            return states
+
+def _ec2_instance_tags_():
+    "Use the EC2 tags API to cheaply get dict of instance id -> tags for all machines (see inventory.py)"
+    tags = {}
+    next_token = None
+    connection = connect()
+    while True:
+        # boto's get_all_tags takes no paging token, so page through DescribeTags directly
+        params = {'Filter.1.Name': 'resource-type', 'Filter.1.Value.1': 'instance', 'MaxResults': 1000}
+        if next_token:
+            params['NextToken'] = next_token
+        page = connection.get_list('DescribeTags', params, [('item', Tag)], verb='POST')
+        for tag in page:
+            tags.setdefault(tag.res_id, {})[tag.name] = tag.value
+        next_token = page.next_token
+        if not next_token:
+            return tags
+
+def _ec2_instances_with_client_tokens_(client_tokens):
+    "Use the EC2 API to get the machines launched by the run_instances calls with the given client tokens"
+    instances = []
+    for reservation in connect().get_all_instances(filters={'client-token': client_tokens}):
+        instances += reservation.instances
+    return instances
+
+def _ec2_instances_with_ids_(instance_ids):
+    "Use the EC2 API to get those of the listed machines that still exist"
+    instances = []
+    # Filtering rather than passing instance_ids, which fails the whole request if any of them is gone. Filters take at
+    # most 200 values.
+    for i in range(0, len(instance_ids), 200):
+        for reservation in connect().get_all_instances(filters={'instance-id': instance_ids[i:i+200]}):
+            instances += reservation.instances
+    return instances
 
 def create_ec2_key_pair():
     env.aws_ec2_ssh_key = "log_parse_%d_%d" % (int(time.time()), int(1000*random.random()))
@@ -101,29 +159,176 @@ def create_ec2_key_pair():
     # Caution: key file left dangling around on disk unless delete_ec2_key_pair is called later on.
     env.key_filename = os.path.join(tempfile.mkdtemp(), env.aws_ec2_ssh_key + ".pem")
     key_pair.save(os.path.dirname(env.key_filename))
+    journal.record_credentials() # so that resuming an interrupted run reuses the key pair
     info("Created temporary EC2 key pair '%s' in '%s'" % (env.aws_ec2_ssh_key, env.key_filename))
 
 
 def _provision_ec2_nodes_(num, next_id):
-    "Provision and return num nodes, after verifying that they are running."
-
-    if not "aws_ec2_ssh_key" in env:
-        create_ec2_key_pair()
-
-    new_reservations = connect().run_instances(
-        env.ec2_ami,
-        min_count=num,
-        max_count=num,
-        key_name=env.aws_ec2_ssh_key,
-        instance_type=env.ec2_instance_type,
-        security_groups=env.aws_ec2_security_groups,
-        security_group_ids=env.aws_ec2_security_group_ids,
-        subnet_id=env.aws_ec2_subnet_id if 'aws_ec2_subnet_id' in env else None)
-    new_nodes = new_reservations.instances
+    """Provision and return up to num nodes, after verifying that they are running.
+    If only some could be launched or came up in time, the failures are logged and the rest are returned."""
+    new_nodes_with_ids = _launch_ec2_nodes_for_provisioning_(num, next_id)
+    waits = concurrently(lambda node_and_id: _wait_for_ec2_provisioning_(node_and_id[0], env.platform, env.role, str(node_and_id[1])),
+                         new_nodes_with_ids, int(env.get('ec2_launch_concurrency', DEFAULT_LAUNCH_CONCURRENCY)) * 4)
+    provisioned = [node for node_and_id, node, e in waits if not e]
+    failed = [node_and_id[0] for node_and_id, node, e in waits if e]
+    for node_and_id, node, e in waits:
+        if e:
+            error(str(e))
+    if failed:
+        # Not returned to the caller and not yet named, so nothing else would ever find them
+        info("Terminating node(s) %s that did not come up." % ", ".join([node.id for node in failed]))
+        try:
+            _decommission_ec2_nodes_(nodes=failed)
+        except BotoServerError, e:
+            error("Could not terminate node(s) %s: %s" % (", ".join([node.id for node in failed]), e.error_message))
+    if len(provisioned) < num:
+        warn("Provisioned %d of %d requested node(s)." % (len(provisioned), num))
+    return provisioned
+
+def _launch_ec2_nodes_for_provisioning_(num, next_id):
+    """Launch up to num nodes without waiting for them to come up.
+    Returns list of (node, sequential id) pairs; see _poll_ec2_provisioning_ for naming them once they are running."""
+    # Creating a temporary key pair and looking for a baked image are independent; overlap them.
+    key_pair = None if "aws_ec2_ssh_key" in env else submit(create_ec2_key_pair)
+    baked_image = None if env.get('ec2_skip_baked_images') else _find_baked_image_()
+    if key_pair:
+        key_pair.result()
+    env.provisioned_from_baked_image = baked_image is not None
+    if baked_image:
+        info("Using baked image %s (%s) instead of %s; bootstrap steps it covers can be skipped." % (baked_image.id, baked_image.name, env.ec2_ami))
+
+    new_nodes = _launch_with_fallback_(baked_image.id if baked_image else env.ec2_ami, num)
+    if not new_nodes:
+        raise RuntimeError("Could not launch any of the %d requested node(s)." % num)
     info("Provisioning node(s) %s" % ", ".join([node.id for node in new_nodes]))
-    new_nodes_with_ids = zip(new_nodes,range(next_id, len(new_nodes)+next_id))
+    if len(new_nodes) < num:
+        warn("Only %d of %d requested node(s) could be launched." % (len(new_nodes), num))
 
-    return map(lambda node_and_id: _wait_for_ec2_provisioning_(node_and_id[0], env.platform, env.role, str(node_and_id[1])), new_nodes_with_ids)
+    # Sequential ids are assigned once all chunks are back, so they stay contiguous across chunks.
+    return zip(new_nodes,range(next_id, len(new_nodes)+next_id))
+
+def _poll_ec2_provisioning_(pending):
+    """Given (node, sequential id) pairs still coming up, names those now running and returns them.
+    Checks all pending nodes with a single API call."""
+    ids = dict([(node.id, identifier) for node, identifier in pending])
+    try:
+        current = _ec2_instances_with_ids_(ids.keys())
+    except BotoServerError, e:
+        # Freshly launched instances are not always visible to describe calls straight away
+        debug("Could not check on new node(s) yet: %s" % e.error_message)
+        return []
+    ready = [node for node in current if node.state == 'running']
+    for node in ready:
+        _name_ec2_node_(node, env.platform, env.role, str(ids[node.id]))
+    return ready
+
+# Placement: nodes may be launched with any of an ordered list of instance types (ec2_instance_types, default
+# ec2_instance_type) into any of an ordered list of subnets (aws_ec2_subnet_ids, default aws_ec2_subnet_id) or, outside
+# a VPC, availability zones (aws_ec2_availability_zones). Nodes are spread evenly over all subnets / zones with the
+# first instance type; whatever EC2 lacks capacity for is launched in the remaining subnets / zones, then with the next
+# instance type, and so on.
+
+class InsufficientCapacity(Exception):
+    """EC2 lacks capacity for an instance type in a subnet / zone. Not retried, as the shortfall is launched elsewhere."""
+    pass
+
+CAPACITY_ERROR_CODES = ('InsufficientInstanceCapacity', 'InsufficientCapacity', 'Unsupported')
+
+def _setting_list_(key):
+    value = env.get(key)
+    if isinstance(value, basestring):
+        value = value.split(',')
+    return [item.strip() for item in (value or []) if item.strip()]
+
+def launch_placements():
+    """Returns ordered list of (instance type, subnet id, availability zone) to launch nodes into, most preferred first."""
+    instance_types = _setting_list_('ec2_instance_types') or [env.ec2_instance_type]
+    subnets = _setting_list_('aws_ec2_subnet_ids') or ([env.aws_ec2_subnet_id] if 'aws_ec2_subnet_id' in env else [])
+    zones = [] if subnets else _setting_list_('aws_ec2_availability_zones')
+    locations = [(subnet, None) for subnet in subnets] or [(None, zone) for zone in zones] or [(None, None)]
+    return [(instance_type, subnet, zone) for instance_type in instance_types for subnet, zone in locations]
+
+def pretty_placement(placement):
+    instance_type, subnet, zone = placement
+    return "%s in %s" % (instance_type, subnet or zone or "default placement")
+
+def _launch_with_fallback_(image_id, num):
+    """Launches up to num nodes as described above. Returns list of new instances, also recording how many went where
+    in env.ec2_launch_placement as list of (placement, count)."""
+    chunk_size = int(env.get('ec2_launch_chunk_size', DEFAULT_LAUNCH_CHUNK_SIZE))
+    placements = launch_placements()
+    exhausted = []
+    launched = dict([(placement, 0) for placement in placements])
+    new_nodes = []
+    remaining = num
+    while remaining > 0:
+        available = [placement for placement in placements if placement not in exhausted]
+        if not available:
+            error("No capacity left for %d node(s) in any of %s." % (remaining, ", ".join([pretty_placement(p) for p in placements])))
+            break
+        # Spread over every subnet / zone of the most preferred instance type that still has capacity
+        tier = [placement for placement in available if placement[0] == available[0][0]]
+        shares = [(placement, remaining / len(tier) + (1 if i < remaining % len(tier) else 0)) for i, placement in enumerate(tier)]
+        # Large shares are split into chunks launched concurrently, so one chunk hitting a per-call limit neither fails
+        # nor delays the rest. Each chunk is retried on its own.
+        chunks = [(placement, min(chunk_size, count - start)) for placement, count in shares for start in range(0, count, chunk_size)]
+        def launch(chunk):
+            placement, count = chunk
+            client_token = str(uuid.uuid4())
+            # Journaled before and after, so resuming an interrupted run finds these instances by client token
+            journal.record_launch_request(client_token, count)
+            try:
+                nodes = _launch_ec2_nodes_(image_id, count, client_token, *placement)
+            except (Exception, SystemExit):
+                journal.record_launch_result(client_token, [])
+                raise
+            journal.record_launch_result(client_token, nodes)
+            return nodes
+        launches = concurrently(launch, chunks, int(env.get('ec2_launch_concurrency', DEFAULT_LAUNCH_CONCURRENCY)))
+        newly_exhausted = False
+        for (placement, count), nodes, e in launches:
+            if isinstance(e, InsufficientCapacity) or (not e and len(nodes) < count):
+                warn("Insufficient capacity for %s; launched %d of %d node(s) there." % (pretty_placement(placement), len(nodes or []), count))
+                if placement not in exhausted:
+                    exhausted.append(placement)
+                    newly_exhausted = True
+            elif e:
+                error("Launching a chunk of %d node(s) as %s failed: %s" % (count, pretty_placement(placement), e))
+                remaining -= count # Not a capacity problem, so not worth launching elsewhere
+            if nodes:
+                new_nodes += nodes
+                launched[placement] += len(nodes)
+                remaining -= len(nodes)
+        if not newly_exhausted:
+            break
+
+    env.ec2_launch_placement = [(placement, launched[placement]) for placement in placements if launched[placement]]
+    if env.ec2_launch_placement:
+        info("Placement: %s" % ", ".join(["%d x %s" % (count, pretty_placement(placement)) for placement, count in env.ec2_launch_placement]))
+    return new_nodes
+
+# EC2 treats repeated requests with the same client token as one, so retrying a chunk whose response was lost cannot
+# launch it twice.
+@retry(BotoServerError, total_tries=4, jitter=True)
+def _launch_ec2_nodes_(image_id, count, client_token, instance_type = None, subnet_id = None, zone = None):
+    """Launch up to count nodes without waiting for them. Returns list of new instances, which is shorter than count if
+    EC2 only had capacity for some; raises InsufficientCapacity if it had none."""
+    try:
+        return connect().run_instances(
+            image_id,
+            min_count=1,
+            max_count=count,
+            key_name=env.aws_ec2_ssh_key,
+            instance_type=instance_type or env.ec2_instance_type,
+            security_groups=env.aws_ec2_security_groups,
+            security_group_ids=env.aws_ec2_security_group_ids,
+            subnet_id=subnet_id or (env.aws_ec2_subnet_id if 'aws_ec2_subnet_id' in env else None),
+            placement=zone,
+            client_token=client_token).instances
+    except BotoServerError, e:
+        if e.error_code in CAPACITY_ERROR_CODES:
+            raise InsufficientCapacity(e.error_message)
+        raise
 
 def _wait_for_ec2_provisioning_(new_node, platform, role, identifier):
     """Waits for instance to come online, applies name to it (using Cloth naming convention)"""
@@ -139,27 +344,84 @@ def _wait_for_ec2_provisioning_(new_node, platform, role, identifier):
             raise RuntimeError("Timeout waiting for %s to be provisioned." % (pretty_instance(new_node)))
         debug("Waiting for %s to come online. Currently '%s'" % (new_node.id, new_node.state))
         time.sleep(5)
-        new_node.update()
+        governor.call(governor.EC2_DESCRIBE, new_node.update)
 
-    new_node.add_tag('Name', "%s-%s-%s" % (platform, role, identifier))
-    new_node.update()
-    info("%s is provisioned." % pretty_instance(new_node))
-    print(green("ssh -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -i %s %s@%s" % (env.key_filename[0], env.user, ip_address(new_node))))
+    _name_ec2_node_(new_node, platform, role, identifier)
+    governor.call(governor.EC2_DESCRIBE, new_node.update)
     return new_node
 
+def _name_ec2_node_(node, platform, role, identifier):
+    "Applies name to a running node (using Cloth naming convention)"
+    governor.call(governor.EC2_MUTATE, node.add_tag, 'Name', "%s-%s-%s" % (platform, role, identifier))
+    info("%s is provisioned." % pretty_instance(node))
+    print(green("ssh -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -i %s %s@%s" % (env.key_filename[0], env.user, ip_address(node))))
+
+## -------------- Baked images ---------------
+# A baked image is an AMI snapshotted from a fully bootstrapped node. It is tagged with a fingerprint of the bootstrap
+# inputs, and _provision_ec2_nodes_ launches from the newest baked image whose fingerprint still matches.
+
+BOOTSTRAP_FINGERPRINT_TAG = 'fabulous:bootstrap-fingerprint'
+
+def bootstrap_fingerprint():
+    """Fingerprint of everything that determines what bootstrapping does to a fresh node: the base AMI, platform and
+    role, plus the values of the env settings listed (comma separated) in env.bootstrap_inputs, e.g. the package list.
+    """
+    keys = [key for key in env.get('bootstrap_inputs', '').split(',') if key]
+    return fingerprint(env.ec2_ami, env.platform, env.role, dict([(key, env.get(key)) for key in keys]))
+
+def bake_image(node = None, name = None, timeout_secs = 1800):
+    """Snapshots a fully bootstrapped node into an AMI tagged with bootstrap_fingerprint(). Returns the new image id.
+    The node is rebooted by EC2 while the image is created, so take it out of service (e.g. use an INACTIVE node).
+    :param node: node to snapshot or None for env.nodes[0]
+    :param name: AMI name; defaults to <platform>-<role>-<timestamp>
+    """
+    node = node or env.nodes[0]
+    name = name or "%s-%s-%s" % (env.platform, env.role, time.strftime("%Y%m%d-%H%M%S"))
+    bootstrap = bootstrap_fingerprint()
+    info("Baking image %s from %s" % (name, pretty_instance(node)))
+    image_id = connect().create_image(node.id, name, description="Baked by fabulous from %s (%s)" % (env.ec2_ami, bootstrap))
+
+    timeout = time.time() + timeout_secs
+    image = connect().get_image(image_id)
+    while image is None or image.state != 'available':
+        if image is not None and image.state == 'failed':
+            raise RuntimeError("Baking image %s from %s failed." % (image_id, pretty_instance(node)))
+        if time.time() > timeout:
+            raise RuntimeError("Timeout waiting for image %s to become available." % image_id)
+        debug("Waiting for image %s. Currently '%s'" % (image_id, image.state if image else "unknown"))
+        time.sleep(15)
+        image = connect().get_image(image_id)
+
+    connect().create_tags([image_id], {BOOTSTRAP_FINGERPRINT_TAG: bootstrap, 'Name': name})
+    info("Baked image %s is available." % image_id)
+    return image_id
+
+def _find_baked_image_():
+    """Returns newest available image owned by this account whose bootstrap fingerprint matches, or None."""
+    images = connect().get_all_images(owners=['self'], filters={
+        'tag:%s' % BOOTSTRAP_FINGERPRINT_TAG: bootstrap_fingerprint(),
+        'state': 'available'
+    })
+    return max(images, key=lambda image: image.creationDate) if images else None
+
 def _munge_etc_hosts_():
     """Add hostname as name for 127.0.0.1 to /etc/hosts.
     Ubuntu AMIs inside VPC annoyingly log 'unable to resolve host ip-www-xxx-yyy-zzz'
-    on every sudo invocation; fix by adding configured hostname to /etc/hosts."""
+    on every sudo invocation; fix by adding configured hostname to /etc/hosts.
+    Still required for nodes launched from baked images, as the hostname is per instance."""
     execute(_munge_etc_hosts_delegate_)
 
+@applied_step(name='munge_etc_hosts', inputs=lambda: env.host_string) # host_string differs for instances launched from a baked image
 def _munge_etc_hosts_delegate_():
     hostname = run("hostname").strip()
     sed('/etc/hosts', '127.0.0.1 localhost', '127.0.0.1 localhost %s' % hostname, use_sudo=True)
 
-def _decommission_ec2_nodes_():
+def _decommission_ec2_nodes_(nodes = None, interactive = True):
+    """Terminates nodes (default env.nodes) unless any of them is behind a load balancer. Unless interactive, raises
+    rather than aborting quietly or asking whether to go ahead when that cannot be checked."""
+    nodes = env.nodes if nodes is None else nodes # Explicit None check because [] is False
     node_ids = {}
-    for node in env.nodes:
+    for node in nodes:
         node_ids[node.id] = node
     ok = True
     try:
@@ -170,14 +432,23 @@ def _decommission_ec2_nodes_():
                     ok = False
         if not ok:
             error("Decommissioning aborted because one or more nodes were behind load balancers.")
+            if not interactive:
+                raise RuntimeError("Not decommissioning %s: behind a load balancer." % pretty_instances(nodes))
     except BotoServerError, e:
         warn("Unable to query AWS for Elastic Load Balancer information: %s" % e.error_message)
-        show(env.nodes)
+        if not interactive:
+            # Typically called from a worker thread (see cloud.decommission_nodes_async), where nobody can answer
+            raise RuntimeError("Not decommissioning %s: cannot guarantee that none of them is behind an ELB." % pretty_instances(nodes))
+        show(nodes)
         ok = confirm("Cannot guarantee that none of the nodes are behind an ELB. Continue?", default=False)
 
     if ok:
         # instance-store backed hosts cannot be stopped, only terminated.
-        connect().terminate_instances([node.id for node in env.nodes])
+        connect().terminate_instances([node.id for node in nodes])
+
+def _tag_ec2_nodes_(nodes, tags):
+    "Applies tags (dict) to all nodes with a single API call."
+    connect().create_tags([node.id for node in nodes], tags)
 
 def delete_ec2_key_pair():
     connect().delete_key_pair(env.aws_ec2_ssh_key)
@@ -294,7 +565,7 @@ def _assign_to_elb_(elb_name = None, nodes = None):
     elb_name = elb_name or env.aws_elb_name
     if elb:
         info("Adding %s to ELB %s" % ([pretty_instance(node) for node in nodes], elb_name))
-        elb.register_instances([node.id for node in nodes])
+        governor.call(governor.ELB, elb.register_instances, [node.id for node in nodes])
 
 
 def _unassign_from_elb_(elb_name=None, nodes = None):
@@ -310,7 +581,7 @@ def _unassign_from_elb_(elb_name=None, nodes = None):
     elb_name = elb_name or env.aws_elb_name
     if elb:
         info("Removing %s from ELB %s" % ([pretty_instance(node) for node in nodes], elb_name))
-        elb.deregister_instances([node.id for node in nodes])
+        governor.call(governor.ELB, elb.deregister_instances, [node.id for node in nodes])
 
 def _enumerate_elb_members_(elb_name=None):
     """Returns list of nodes behind the Elastic Load Balancer.
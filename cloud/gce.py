@@ -1,8 +1,9 @@
 from fabric.api import env
-from .import pretty_instance
+from .import governor, pretty_instance
 from .. import debug, error, info, run_and_return_result, warn
 from ..config import verify_env_contains_keys
 import json
+import sys
 from os.path import expanduser
 
 # Should probably use Google's Python API rather than invoking gcutil. The GoogleComputeEngineInstance shim
@@ -18,9 +19,9 @@ def gce_config():
 
     result = verify_env_contains_keys('google_storage_access_key','google_storage_secret_key')
     if result:
-        code,stdout,stderr = run_and_return_result(['gcutil','auth','--just_check_auth'])
+        code,stdout,stderr = _gcutil_(['gcutil','auth','--just_check_auth'])
         if code == 0:
-            code,stdout,stderr = run_and_return_result(['gcutil','getproject','--format=json'])
+            code,stdout,stderr = _gcutil_(['gcutil','getproject','--format=json'])
             if code == 0:
                 project = json.loads(stdout)
                 env.google_project_name = project.get('name')
@@ -41,6 +42,21 @@ def gce_config():
     return False
 
 
+def _gcutil_(args, assert_successful=False):
+    """Runs gcutil via run_and_return_result, governed as GCE API calls (see governor.py).
+    Logs error and exits(!) on non-zero response if assert_successful."""
+    def attempt():
+        code,stdout,stderr = run_and_return_result(args)
+        if code > 0 and ('rateLimitExceeded' in stderr or 'Rate Limit Exceeded' in stderr):
+            raise governor.Throttled(stderr)
+        return (code,stdout,stderr)
+    code,stdout,stderr = governor.call(governor.GCE, attempt)
+    if (code > 0 and assert_successful):
+        error("Could not execute %s:\n%s" % (" ".join(args), stderr))
+        sys.exit(1)
+    return (code,stdout,stderr)
+
+
 class GoogleComputeEngineInstance:
     def __init__(self,gcutil_response):
         self.id = gcutil_response["id"]
@@ -66,7 +82,7 @@ class GoogleComputeEngineInstance:
 def _google_compute_engine_instances_():
     "Use the gcutil command line to get a list of all machines"
     instances = []
-    code,stdout,stderr = run_and_return_result(['gcutil','listinstances','--format=json'], assert_successful=True)
+    code,stdout,stderr = _gcutil_(['gcutil','listinstances','--format=json'], assert_successful=True)
     response = json.loads(stdout)
     items = response["items"]
     for item in items:
@@ -81,11 +97,11 @@ def _provision_gce_nodes_(num,next_id):
     "Provision and return num nodes, after verifying that they are running."
 
     #gcutil addfirewall http2 --description="Incoming http allowed." --allowed="tcp:http"
-    names = map(lambda x: "%s-%s-%d" % (env.platform, env.role, x), range(1,num+1))
+    names = map(lambda x: "%s-%s-%d" % (env.platform, env.role, x), range(next_id,num+next_id))
     info("Provisioning nodes %s" % ", ".join(names))
 
-    run_and_return_result(['gcutil','addfirewall','http8080','--description="Incoming http (port 8080) allowed."','--allowed=tcp:8080'], assert_successful=True)
-    code,stdout,stderr = run_and_return_result(['gcutil','addinstance','--zone=%s'%env.gce_zone, '--machine_type=%s'%env.gce_machine_type,'--format=json'] + names, assert_successful=True)
+    _gcutil_(['gcutil','addfirewall','http8080','--description="Incoming http (port 8080) allowed."','--allowed=tcp:8080'], assert_successful=True)
+    code,stdout,stderr = _gcutil_(['gcutil','addinstance','--zone=%s'%env.gce_zone, '--machine_type=%s'%env.gce_machine_type,'--format=json'] + names, assert_successful=True)
     response = json.loads(stdout[stdout.find('{'):]) # Move past log messages to beginning of response
     items = filter(lambda item: item.get("kind") == "compute#instance", response["items"]) # One item in response is operation acknowledgement (kind:compute#operation), not node info
     instances = []
@@ -97,6 +113,7 @@ def _provision_gce_nodes_(num,next_id):
         print("ssh -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -i %s %s@%s" % (env.key_filename[0], env.user, new_node.ip_address))
     return instances
 
-def _decommission_gce_nodes_():
-    names = map(lambda node: node.tags.get("Name"), env.nodes)
-    run_and_return_result(['gcutil','deleteinstance','-f']+names, assert_successful=True)
\ No newline at end of file
+def _decommission_gce_nodes_(nodes = None, interactive = True):
+    nodes = env.nodes if nodes is None else nodes # Explicit None check because [] is False
+    names = map(lambda node: node.tags.get("Name"), nodes)
+    _gcutil_(['gcutil','deleteinstance','-f']+names, assert_successful=True)
\ No newline at end of file
@@ -0,0 +1,121 @@
+"""
+Process-wide rate governor for cloud provider API calls.
+
+Every provider API call goes through call(family, f, ...), which takes a token from the token bucket for that API
+family before calling. When the provider signals throttling (e.g. EC2 RequestLimitExceeded), the family's rate is
+halved and the call is retried after a jittered backoff, until api_deadline_seconds (default 120) have passed. Each
+success then restores the rate gradually. Parallel hosts and threads therefore back off together, and stop retrying
+in lockstep, instead of keeping the account throttled.
+
+Families and their default sustained rates (calls per second) are below. Override with e.g. api_rate_ec2_describe=20;
+bursts of up to twice the rate are allowed.
+"""
+from boto.exception import BotoServerError
+from fabric.api import env
+from .. import debug, warn
+import random
+import threading
+import time
+
+EC2_DESCRIBE, EC2_MUTATE, ELB, GCE = ['ec2_describe', 'ec2_mutate', 'elb', 'gce']
+DEFAULT_RATES = {EC2_DESCRIBE: 10.0, EC2_MUTATE: 5.0, ELB: 5.0, GCE: 5.0}
+DEFAULT_DEADLINE_SECONDS = 120
+MIN_RATE = 0.2
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 20
+
+THROTTLE_ERROR_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'SlowDown')
+
+class Throttled(Exception):
+    """Raised by callers of call() whose provider reports throttling without an exception of its own (e.g. gcutil)."""
+    pass
+
+class TokenBucket(object):
+    """Thread-safe token bucket whose rate backs off multiplicatively when throttled and recovers additively."""
+    def __init__(self, rate):
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = rate * 2
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        "Blocks until a token is available, then takes it."
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.rate * 2, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(MIN_RATE, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+_buckets_ = {}
+_buckets_lock_ = threading.Lock()
+
+def bucket(family):
+    """Returns the process-wide TokenBucket for family."""
+    with _buckets_lock_:
+        if family not in _buckets_:
+            _buckets_[family] = TokenBucket(float(env.get('api_rate_' + family, DEFAULT_RATES.get(family, 5.0))))
+        return _buckets_[family]
+
+def is_throttle(e):
+    """Returns True if exception e is the provider asking us to slow down."""
+    if isinstance(e, Throttled):
+        return True
+    return isinstance(e, BotoServerError) and (e.error_code in THROTTLE_ERROR_CODES or e.status == 503)
+
+def call(family, f, *args, **kwargs):
+    """Calls f(*args, **kwargs) once a token for family is available, retrying with jittered exponential backoff while
+    the provider is throttling, up to api_deadline_seconds. Other errors are raised straight away."""
+    family_bucket = bucket(family)
+    deadline = time.time() + float(env.get('api_deadline_seconds', DEFAULT_DEADLINE_SECONDS))
+    attempt = 0
+    while True:
+        family_bucket.acquire()
+        try:
+            result = f(*args, **kwargs)
+        except Exception, e:
+            if not is_throttle(e):
+                raise
+            family_bucket.throttled()
+            delay = random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+            if time.time() + delay > deadline:
+                warn("%s API still throttled at deadline; giving up on %s." % (family, getattr(f, '__name__', f)))
+                raise
+            debug("%s API throttled; now limited to %.1f calls/s. Retrying %s in %.1fs." % (family, family_bucket.rate, getattr(f, '__name__', f), delay))
+            time.sleep(delay)
+            attempt += 1
+            continue
+        family_bucket.succeeded()
+        return result
+
+class GovernedConnection(object):
+    """Wraps a boto connection so each of its API methods goes through call(), classified as a describe (read) or
+    mutate call by method name unless the connection has a single family."""
+    def __init__(self, connection, describe_family, mutate_family = None):
+        self._connection = connection
+        self._describe_family = describe_family
+        self._mutate_family = mutate_family or describe_family
+
+    def __getattr__(self, name):
+        attribute = getattr(self._connection, name)
+        if not callable(attribute) or name.startswith('_'):
+            return attribute
+        family = self._describe_family if name.startswith('get_') or name.startswith('describe') else self._mutate_family
+        def governed(*args, **kwargs):
+            return call(family, attribute, *args, **kwargs)
+        governed.__name__ = name
+        return governed
@@ -0,0 +1,172 @@
+"""
+Hybrid clusters: several cloud providers active in one run, e.g. AWS for the base cluster plus Google Compute Engine
+for burst capacity. Enabled by listing the providers instead of naming one:
+    providers = ec2,google_compute_engine
+    provider_weights = ec2:3,google_compute_engine:1    # share of newly provisioned nodes; equal if omitted
+
+Each provider is configured by its usual provider_config_function. Its provider functions, SSH user and key are kept
+in env.provider_registry and env's provider functions are replaced by composites that:
+ - enumerate instances from all providers concurrently and merge them, marking each node with node.provider
+ - split newly provisioned nodes across providers by weight, keeping sequential ids contiguous, and provision concurrently
+ - dispatch decommissioning (concurrently), post-provision hooks and tagging to each node's own provider
+Nodes are reached as <provider's SSH user>@<address>, and env.key_filename lists every provider's key.
+Load balancer and virtual IP functions are those of the first provider listed; nodes of other providers cannot join it.
+With EC2 in the mix, aws_ec2_ssh_key must be configured, as a temporary key pair would replace the other providers' keys.
+"""
+from fabric.api import env
+from . import pretty_instances, use_only
+from .. import concurrently, error, info, warn
+from ..config import _configure_provider_
+import sys
+
+# Settings each provider_config_function may set that differ between providers
+PROVIDER_SETTINGS = ('user', 'key_filename')
+
+def configure_providers(names):
+    """Configures each named provider and installs the composite provider functions. Returns True on success."""
+    registry = {}
+    original_settings = dict([(key, env.get(key)) for key in PROVIDER_SETTINGS])
+    for name in names:
+        _clear_provider_functions_()
+        env.update(original_settings) # each provider configures from the same starting point
+        env.provider = name
+        if not _configure_provider_():
+            error("No provider_config_function handles provider '%s'." % name)
+            sys.exit(1)
+        registry[name] = dict([(key, env[key]) for key in env.keys() if key.startswith('provider_') and callable(env[key])])
+        for key in PROVIDER_SETTINGS:
+            registry[name][key] = env.get(key)
+
+    if 'ec2' in registry and 'aws_ec2_ssh_key' not in env:
+        error("Hybrid clusters including EC2 require aws_ec2_ssh_key (and -i) to be configured.")
+        sys.exit(1)
+
+    env.provider_registry = registry
+    env.provider = ",".join(names)
+    env.key_filename = []
+    for name in names:
+        key_filename = registry[name].get('key_filename')
+        env.key_filename += key_filename if isinstance(key_filename, list) else [key_filename] if key_filename else []
+
+    _clear_provider_functions_()
+    primary = registry[names[0]]
+    for key in primary:
+        if key.startswith('provider_load_balancer_') or key.startswith('provider_virtual_ip_'):
+            env[key] = primary[key]
+    env.provider_instance_function = _hybrid_instances_
+    env.provider_provision_function = _hybrid_provision_
+    env.provider_decommission_function = _hybrid_decommission_
+    env.provider_post_provision_hook = _hybrid_post_provision_hook_
+    env.provider_tag_nodes_function = _hybrid_tag_nodes_
+    info("Hybrid cluster across providers %s (weights %s)" % (", ".join(names), provider_weights()))
+    return True
+
+def _clear_provider_functions_():
+    for key in [key for key in env.keys() if key.startswith('provider_') and callable(env[key])]:
+        del env[key]
+
+def provider_weights():
+    """Returns dict of provider name -> weight from env.provider_weights, defaulting to 1 for each provider."""
+    weights = dict([(name, 1.0) for name in env.provider_registry])
+    for entry in [entry for entry in env.get('provider_weights', '').split(',') if entry.strip()]:
+        name, weight = entry.split(':')
+        if name.strip() not in weights:
+            warn("Ignoring weight for unconfigured provider '%s'" % name.strip())
+        else:
+            weights[name.strip()] = float(weight)
+    return weights
+
+def provider_of(node):
+    """Returns name of the provider node belongs to, or None outside of hybrid mode."""
+    return getattr(node, 'provider', None)
+
+def split_by_weight(num):
+    """Returns list of (provider name, count) apportioning num nodes by provider weight, in configured order."""
+    names = env.provider.split(',')
+    weights = provider_weights()
+    total = sum([weights[name] for name in names]) or 1
+    counts = [int(num * weights[name] / total) for name in names]
+    # Hand out the remainder to the providers with the largest fractional shares
+    remainders = sorted(range(len(names)), key=lambda i: num * weights[names[i]] / total - counts[i], reverse=True)
+    for i in remainders[:num - sum(counts)]:
+        counts[i] += 1
+    return [(name, count) for name, count in zip(names, counts) if count > 0]
+
+def _hybrid_instances_():
+    def fetch(name):
+        nodes = env.provider_registry[name]['provider_instance_function']()
+        for node in nodes:
+            node.provider = name
+        return nodes
+    merged = []
+    for name, nodes, e in concurrently(fetch, env.provider.split(',')):
+        if e:
+            error("Listing instances on %s failed: %s: %s" % (name, type(e).__name__, e))
+            raise e
+        merged += nodes
+    return merged
+
+def _hybrid_provision_(num, next_id):
+    split = split_by_weight(num)
+    info("Provisioning split across providers: %s" % ", ".join(["%s: %d" % share for share in split]))
+    batches = []
+    first_id = next_id
+    for name, count in split:
+        batches.append((name, count, first_id))
+        first_id += count
+
+    def provision(batch):
+        name, count, first_id = batch
+        nodes = env.provider_registry[name]['provider_provision_function'](count, first_id)
+        for node in nodes:
+            node.provider = name
+        return nodes
+    provisioned = []
+    for (name, count, first_id), nodes, e in concurrently(provision, batches):
+        if e:
+            error("Provisioning %d node(s) on %s failed: %s: %s" % (count, name, type(e).__name__, e))
+        else:
+            provisioned += nodes
+    return provisioned
+
+def _by_provider_(nodes):
+    groups = {}
+    for node in nodes:
+        groups.setdefault(provider_of(node), []).append(node)
+    return groups
+
+def _hybrid_decommission_(nodes = None, interactive = True):
+    nodes = env.nodes if nodes is None else nodes # Explicit None check because [] is False
+    groups = []
+    for name, group in _by_provider_(nodes).iteritems():
+        if name not in env.provider_registry:
+            error("Cannot decommission %s: provider unknown." % pretty_instances(group))
+        else:
+            groups.append((name, group))
+
+    def decommission(name_and_group):
+        # Nodes are passed explicitly rather than via env.nodes, which the threads share
+        name, group = name_and_group
+        env.provider_registry[name]['provider_decommission_function'](nodes=group, interactive=interactive)
+    for (name, group), result, e in concurrently(decommission, groups):
+        if e:
+            error("Decommissioning %s on %s failed: %s: %s" % (pretty_instances(group), name, type(e).__name__, e))
+
+def _hybrid_post_provision_hook_():
+    all_nodes = list(env.nodes)
+    try:
+        for name, nodes in _by_provider_(all_nodes).iteritems():
+            hook = env.provider_registry.get(name, {}).get('provider_post_provision_hook')
+            if hook:
+                use_only(*nodes)
+                hook()
+    finally:
+        use_only(*all_nodes)
+
+def _hybrid_tag_nodes_(nodes, tags):
+    for name, group in _by_provider_(nodes).iteritems():
+        tag_nodes = env.provider_registry.get(name, {}).get('provider_tag_nodes_function')
+        if tag_nodes:
+            tag_nodes(group, tags)
+        else:
+            warn("Provider %s does not support tagging nodes; not tagging %s." % (name, pretty_instances(group)))
@@ -0,0 +1,156 @@
+"""
+Optional on-disk cache of the provider's instance inventory, so read-only tasks (list, active, inactive, ...) do not
+have to enumerate the whole account or project on every fab invocation.
+
+Enable with inventory_cache=true. The cache is a SQLite database under the fabulous cache directory, keyed by provider
+and region / project. When the provider supplies env.provider_instance_states_function and
+env.provider_instance_tags_function (cheap id -> state and id -> tags listings) and env.provider_instances_by_id_function,
+each use refreshes incrementally: only instances that are new, changed state, or are running but still missing a name
+or address are described again, tags are brought up to date from the listing, and instances that disappeared are
+dropped. Otherwise, and in any case once the last full sync is older than inventory_cache_ttl seconds (default 3600),
+the whole inventory is re-fetched. Tasks that change the inventory (provision, decommission) invalidate it.
+
+CachedInstances only carry the attributes listed in CachedInstance.FIELDS, so tasks that select nodes from the cache
+for other tasks to change hand on the provider's own objects instead (see cloud.fresh_nodes).
+"""
+from fabric.api import env
+from .. import cache_directory, debug, submit
+from os import path
+import json
+import sqlite3
+import threading
+import time
+
+DEFAULT_TTL_SECONDS = 3600
+
+# Refreshes are serialized, as concurrent lookups (see cloud.instances_async) would otherwise contend for the database
+_sync_lock_ = threading.Lock()
+
+class CachedInstance(object):
+    """Snapshot of the instance attributes fabulous relies on, detached from any provider API connection."""
+    FIELDS = ('id', 'ip_address', 'private_ip_address', 'state', 'launch_time', 'tags')
+
+    def __init__(self, **fields):
+        for field in CachedInstance.FIELDS:
+            setattr(self, field, fields.get(field))
+        self.tags = self.tags or {}
+        self.provider = fields.get('provider')
+
+    @staticmethod
+    def of(node):
+        fields = dict([(field, getattr(node, field, None)) for field in CachedInstance.FIELDS])
+        fields['tags'] = dict(node.tags or {})
+        fields['provider'] = getattr(node, 'provider', None)
+        return CachedInstance(**fields)
+
+    def as_json(self):
+        fields = dict([(field, getattr(self, field)) for field in CachedInstance.FIELDS])
+        fields['provider'] = self.provider
+        return json.dumps(fields)
+
+    def __eq__(self, other):
+        return isinstance(other, CachedInstance) and self.id == other.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return "<Cached instance %s '%s' @ '%s'>" % (self.id, self.tags.get("Name"), self.ip_address or self.private_ip_address)
+
+def is_enabled():
+    enabled = env.get('inventory_cache')
+    if isinstance(enabled, basestring): # configure() may not have converted it yet
+        return enabled.lower() in ("y","yes","t","true","1","enabled","on")
+    return bool(enabled)
+
+def scope():
+    """Cache key for the account / project the current provider configuration points at."""
+    return "%s/%s" % (env.get('provider'), env.get('aws_ec2_region') or env.get('google_project_name') or '')
+
+def _connect_():
+    db = sqlite3.connect(path.join(cache_directory('inventory'), 'inventory.db'))
+    db.execute("CREATE TABLE IF NOT EXISTS instances (scope TEXT, id TEXT, state TEXT, data TEXT, PRIMARY KEY (scope, id))")
+    db.execute("CREATE TABLE IF NOT EXISTS syncs (scope TEXT PRIMARY KEY, full_sync REAL)")
+    return db
+
+def cached_instances():
+    """Returns the provider's instances as CachedInstances, refreshing the cache first as described above."""
+    with _sync_lock_:
+        return _cached_instances_()
+
+def _cached_instances_():
+    db = _connect_()
+    try:
+        key = scope()
+        row = db.execute("SELECT full_sync FROM syncs WHERE scope = ?", (key,)).fetchone()
+        ttl = int(env.get('inventory_cache_ttl', DEFAULT_TTL_SECONDS))
+        incremental = all([hook in env for hook in ('provider_instance_states_function', 'provider_instance_tags_function',
+                                                    'provider_instances_by_id_function')])
+        if row is None or time.time() - row[0] > ttl:
+            _full_sync_(db, key)
+        elif incremental:
+            _incremental_sync_(db, key)
+        db.commit()
+        return [CachedInstance(**json.loads(data)) for (data,) in db.execute("SELECT data FROM instances WHERE scope = ?", (key,))]
+    finally:
+        db.close()
+
+def _full_sync_(db, key):
+    debug("Inventory cache: full resync of %s" % key)
+    nodes = [CachedInstance.of(node) for node in env.provider_instance_function()]
+    db.execute("DELETE FROM instances WHERE scope = ?", (key,))
+    db.executemany("INSERT INTO instances VALUES (?, ?, ?, ?)", [(key, node.id, node.state, node.as_json()) for node in nodes])
+    db.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?)", (key, time.time()))
+
+def _incremental_sync_(db, key):
+    cached = dict([(node.id, node) for node in
+                   [CachedInstance(**json.loads(data)) for (data,) in db.execute("SELECT data FROM instances WHERE scope = ?", (key,))]])
+    tags = submit(env.provider_instance_tags_function)
+    states = env.provider_instance_states_function()
+    tags = tags.result()
+    gone = [node_id for node_id in cached if node_id not in states]
+    changed = [node_id for node_id, state in states.iteritems()
+               if node_id not in cached
+               or cached[node_id].state != state
+               or (state == 'running' and not (cached[node_id].tags.get("Name") and
+                                               (cached[node_id].ip_address or cached[node_id].private_ip_address)))]
+    # Tags change without the state changing, e.g. when another run tags nodes; update them from the listing
+    retagged = [cached[node_id] for node_id in states if node_id in cached and node_id not in changed
+                and cached[node_id].tags != tags.get(node_id, {})]
+    for node in retagged:
+        node.tags = tags.get(node.id, {})
+    debug("Inventory cache: %d new or changed, %d retagged, %d gone, %d unchanged in %s" %
+          (len(changed), len(retagged), len(gone), len(states) - len(changed) - len(retagged), key))
+    db.executemany("DELETE FROM instances WHERE scope = ? AND id = ?", [(key, node_id) for node_id in gone])
+    db.executemany("UPDATE instances SET data = ? WHERE scope = ? AND id = ?", [(node.as_json(), key, node.id) for node in retagged])
+    if changed:
+        nodes = [CachedInstance.of(node) for node in env.provider_instances_by_id_function(changed)]
+        db.executemany("INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?)", [(key, node.id, node.state, node.as_json()) for node in nodes])
+
+def store(nodes):
+    """Updates the cached records of nodes, e.g. after changing their tags (which does not change their state, so
+    would not be picked up by an incremental refresh)."""
+    if not is_enabled():
+        return
+    db = _connect_()
+    try:
+        key = scope()
+        db.executemany("INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?)",
+                       [(key, node.id, node.state, node.as_json()) for node in [CachedInstance.of(node) for node in nodes]])
+        db.commit()
+    finally:
+        db.close()
+
+def invalidate():
+    """Forces a full resync on next use. Call after changing the inventory outside of fabulous' own tasks."""
+    if not is_enabled():
+        return
+    db = _connect_()
+    try:
+        db.execute("DELETE FROM syncs WHERE scope = ?", (scope(),))
+        db.commit()
+    finally:
+        db.close()
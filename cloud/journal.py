@@ -0,0 +1,149 @@
+"""
+Checkpoint journal for provisioning runs, so an interrupted run (timeout, SSH failure, Ctrl-C) can be resumed rather
+than started over. While a run is in progress the controlling process records, in a local JSON file per platform and
+role under the fabulous cache directory:
+ - the launch request (number of nodes, first sequential id)
+ - the SSH key pair in use, so a temporary one created for the run is reused rather than left dangling
+ - each call the provider makes to launch instances, before making it (with the client token identifying it), and the
+   instances it launched as soon as it returns
+ - the sequential id assigned to each launched instance
+ - each stage each node has completed (provisioned, i.e. running and tagged; ssh_ready; post_provision; any
+   caller-supplied stages)
+The journal is removed once every node has completed every stage, and kept otherwise. It also records the process
+writing it, so other runs can tell whether it is still in progress. Resuming (see cloud.resume_provisioning) adopts the
+instances already launched, takes each one on from its last completed stage and launches only the remaining shortfall. Instances of launch calls that never returned are found by client token, where
+the provider supports it (env.provider_instances_by_client_token_function).
+
+Providers journal their launch calls via record_launch_request / record_launch_result, which apply to the run in
+progress in this process, if any.
+"""
+from fabric.api import env
+from .. import cache_directory, debug, warn
+from . import inventory
+from os import path
+import errno
+import json
+import os
+import threading
+import time
+
+# SSH credentials a run may create for itself (see aws.create_ec2_key_pair) and a resumed run must reuse
+CREDENTIAL_SETTINGS = ('aws_ec2_ssh_key', 'key_filename')
+
+# Journal of the run in progress in this process; providers may record launch calls from several threads at once
+_active_ = None
+_lock_ = threading.RLock()
+
+def activate(journal):
+    """Makes journal the one launch calls are recorded in (None to stop recording)."""
+    global _active_
+    _active_ = journal
+
+def journal_path():
+    return path.join(cache_directory('journal'), "%s-%s.json" % (env.platform, env.role))
+
+def load():
+    """Returns the journal of the interrupted run for the current platform and role, or None."""
+    if not path.exists(journal_path()):
+        return None
+    with open(journal_path()) as f:
+        journal = json.load(f)
+    if journal.get('scope') != inventory.scope():
+        warn("Ignoring journal of a run against %s; now configured for %s." % (journal.get('scope'), inventory.scope()))
+        return None
+    journal.setdefault('requests', {}) # journals written before launch calls were recorded
+    return journal
+
+def start(num, next_id):
+    """Starts the journal of a new run, replacing any left by an interrupted one."""
+    if path.exists(journal_path()):
+        warn("Discarding journal of an interrupted run; use the resume task to continue such a run instead.")
+    journal = {'scope': inventory.scope(), 'started': time.time(), 'num': num, 'next_id': next_id,
+               'credentials': {}, 'requests': {}, 'nodes': {}}
+    _save_(journal)
+    return journal
+
+def record_credentials(journal = None):
+    """Records the SSH credentials now in env (default in the active journal), e.g. as soon as a temporary key pair has
+    been created for the run."""
+    journal = journal or _active_
+    if journal is None:
+        return
+    credentials = dict([(key, env.get(key)) for key in CREDENTIAL_SETTINGS if env.get(key)])
+    if credentials != journal['credentials']:
+        journal['credentials'] = credentials
+        _save_(journal)
+
+def restore_credentials(journal):
+    """Puts the journaled SSH credentials back in env, unless configured explicitly for this run."""
+    if journal['credentials'].get('aws_ec2_ssh_key') and 'aws_ec2_ssh_key' not in env:
+        for key, value in journal['credentials'].iteritems():
+            env[key] = value
+        debug("Reusing SSH key pair %s of the interrupted run" % env.aws_ec2_ssh_key)
+
+def record_launch_request(token, count, journal = None):
+    """Records that a launch call identified by client token is about to be made (default in the active journal)."""
+    with _lock_:
+        journal = journal or _active_
+        if journal is not None:
+            journal['requests'][token] = {'count': count, 'instances': None}
+            _save_(journal)
+
+def record_launch_result(token, nodes, journal = None):
+    """Records the instances the launch call identified by client token launched (default in the active journal)."""
+    with _lock_:
+        journal = journal or _active_
+        if journal is not None:
+            journal['requests'][token] = {'count': len(nodes), 'instances': [node.id for node in nodes]}
+            for node in nodes:
+                journal['nodes'].setdefault(node.id, {'seq': None, 'stages': []})
+            _save_(journal)
+
+def unanswered_launch_requests(journal):
+    """Returns client tokens of launch calls that were made but never returned."""
+    return [token for token, request in journal['requests'].iteritems() if request['instances'] is None]
+
+def record_launched(journal, nodes_with_ids):
+    """Records (node, sequential id) pairs as launched."""
+    for node, identifier in nodes_with_ids:
+        journal['nodes'].setdefault(node.id, {'seq': None, 'stages': []})['seq'] = int(identifier)
+    _save_(journal)
+
+def record_stage(journal, node, stage):
+    """Records that node completed stage."""
+    entry = journal['nodes'].setdefault(node.id, {'seq': None, 'stages': []})
+    if stage not in entry['stages']:
+        entry['stages'].append(stage)
+        _save_(journal)
+
+def completed_stages(journal, node_id):
+    return journal['nodes'].get(node_id, {}).get('stages', [])
+
+def forget(journal, node_id):
+    """Drops a node from the journal, e.g. as it was lost while the run was interrupted."""
+    journal['nodes'].pop(node_id, None)
+    _save_(journal)
+
+def in_progress(journal):
+    """Returns True if the process that last wrote journal is still running, i.e. the run has not been interrupted."""
+    if not journal.get('pid'):
+        return False
+    try:
+        os.kill(journal['pid'], 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+def finish(journal):
+    """Removes the journal of a completed run."""
+    if path.exists(journal_path()):
+        os.remove(journal_path())
+
+def _save_(journal):
+    # Write then rename, so an interruption mid-write leaves the previous checkpoint intact
+    with _lock_:
+        journal['pid'] = os.getpid() # the run is in progress for as long as this process lives (see in_progress)
+        temporary = journal_path() + ".tmp"
+        with open(temporary, 'w') as f:
+            json.dump(journal, f)
+        os.rename(temporary, journal_path())
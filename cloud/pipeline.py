@@ -0,0 +1,263 @@
+"""
+Per-node provisioning pipeline. Rather than waiting for every node to finish one phase before any node starts the next,
+each node moves through the stages on its own:
+    provisioned -> ssh_ready -> post_provision -> caller-supplied stages (e.g. install_packages, deploy)
+so the first node to boot can be serving while the slowest is still booting.
+
+Nodes come up via env.provider_launch_function / env.provider_poll_provisioning_function where the provider supplies
+them (all nodes are polled with one call), otherwise via env.provider_provision_function. SSH stages for each node run
+in a worker process of their own, so env.host_string and use() are per node; at most pipeline_pool_size (default 20)
+workers run at once, and each stage can bound its own concurrency further.
+
+Stages are given as callables or (name, callable) or (name, callable, max concurrency) tuples, and are executed against
+the single node like a Fabric task. Completion events are delivered to the caller in the controlling process:
+on_event(node, stage_name) after each stage and on_node_ready(node) once a node has completed every stage, e.g. to
+register it with the load balancer straight away.
+
+Progress is checkpointed in a journal (see journal.py). Passing the journal of an interrupted run as resume adopts the
+instances it launched, skips the stages each has completed, and launches only the shortfall.
+"""
+from fabric.api import env, execute
+from fabric.state import connections
+from . import PROVISIONING_DONE, PROVISIONING_FAILED, PROVISIONING_IN_PROGRESS, decommission_nodes_async, instances_with_ids, journal, mark_provisioning, pretty_instance, use_only, wait_for_ssh_access
+from .. import debug, error, info, warn
+from multiprocessing import BoundedSemaphore, Process, Queue
+from Queue import Empty
+import time
+
+PROVISIONED, SSH_READY, POST_PROVISION = ['provisioned', 'ssh_ready', 'post_provision']
+DEFAULT_POOL_SIZE = 20
+POLL_INTERVAL_SECONDS = 5
+
+def run_pipeline(num, next_id, stages = None, on_event = None, on_node_ready = None, resume = None):
+    """Provisions num nodes (named from next_id onwards) and takes each through all stages independently.
+    Returns the nodes that completed every stage, in the order they did so. Failures are logged and left in
+    env.pipeline_failures as dict of node id -> (stage name, error).
+    With resume (a journal), num and next_id are taken from it and the run continues where it was interrupted."""
+    pool_size = int(env.get('pipeline_pool_size', DEFAULT_POOL_SIZE))
+    node_stages = [(SSH_READY, wait_for_ssh_access, pool_size), (POST_PROVISION, _post_provision_, pool_size)]
+    node_stages += [_as_stage_(stage, pool_size) for stage in (stages or [])]
+    semaphores = [BoundedSemaphore(concurrency) for name, f, concurrency in node_stages]
+    events = Queue()
+
+    start = time.time()
+    deadline = start + (env.provisioning_timeout or 180)
+    nodes_by_id = {}
+    queued = []
+    running = {}
+    ready = []
+    failures = {}
+
+    def provisioned(nodes):
+        for node in nodes:
+            nodes_by_id[node.id] = node
+            queued.append(node)
+            journal.record_stage(checkpoints, node, PROVISIONED)
+            if on_event:
+                on_event(node, PROVISIONED)
+
+    def handle(event):
+        node_id, index, ok, message = event
+        node = nodes_by_id[node_id]
+        name = node_stages[index][0]
+        if not ok:
+            failures[node_id] = (name, message)
+            error("%s failed at stage %s: %s" % (pretty_instance(node), name, message))
+            return
+        debug("%s completed stage %s" % (pretty_instance(node), name))
+        journal.record_stage(checkpoints, node, name)
+        if on_event:
+            on_event(node, name)
+        if index == len(node_stages) - 1:
+            mark_provisioning([node], PROVISIONING_DONE)
+            ready.append(node)
+            info("%s is ready after %ds (%d of %d)." % (pretty_instance(node), time.time() - start, len(ready), num))
+            if on_node_ready:
+                on_node_ready(node)
+
+    pending = []
+    if resume:
+        checkpoints = resume
+        num, next_id = checkpoints['num'], checkpoints['next_id']
+        journal.restore_credentials(checkpoints)
+        adopted, pending = _adopt_(checkpoints)
+        for node in adopted:
+            nodes_by_id[node.id] = node
+            queued.append(node)
+        next_id = max([next_id - 1] + [entry['seq'] for entry in checkpoints['nodes'].values() if entry['seq']]) + 1
+        # Instances of launch calls interrupted before their results were numbered get the next free ids
+        unnumbered = [node for node, identifier in pending if identifier is None]
+        if unnumbered:
+            journal.record_launched(checkpoints, [(node, next_id + i) for i, node in enumerate(unnumbered)])
+            pending = [(node, checkpoints['nodes'][node.id]['seq']) for node, identifier in pending]
+            next_id += len(unnumbered)
+        shortfall = num - len(adopted) - len(pending)
+        info("Resuming: adopted %d node(s), %d still coming up, %d to launch." % (len(adopted), len(pending), max(shortfall, 0)))
+    else:
+        checkpoints = journal.start(num, next_id)
+        shortfall = num
+
+    if shortfall > 0 and 'provider_launch_function' in env and 'provider_poll_provisioning_function' in env:
+        launched = _journaled_(checkpoints, env.provider_launch_function, shortfall, next_id)
+        journal.record_launched(checkpoints, launched)
+        mark_provisioning([node for node, identifier in launched], PROVISIONING_IN_PROGRESS)
+        pending += launched
+    elif shortfall > 0:
+        nodes = _journaled_(checkpoints, env.provider_provision_function, shortfall, next_id)
+        journal.record_launched(checkpoints, [(node, next_id + i) for i, node in enumerate(nodes)])
+        provisioned(nodes)
+
+    next_poll = 0
+    while pending or queued or running:
+        if pending and time.time() >= next_poll:
+            now_running = env.provider_poll_provisioning_function(pending)
+            now_running_ids = set([node.id for node in now_running])
+            pending = [(node, identifier) for node, identifier in pending if node.id not in now_running_ids]
+            provisioned(now_running)
+            if pending and time.time() > deadline:
+                for node, identifier in pending:
+                    nodes_by_id[node.id] = node
+                    failures[node.id] = (PROVISIONED, "Timeout waiting for node to be provisioned.")
+                    error("Timeout waiting for %s to be provisioned." % node.id)
+                _discard_timed_out_(checkpoints, [node for node, identifier in pending])
+                pending = []
+            next_poll = time.time() + POLL_INTERVAL_SECONDS
+
+        while queued and len(running) < pool_size:
+            node = queued.pop(0)
+            done = journal.completed_stages(checkpoints, node.id)
+            first = len([name for name, f, concurrency in node_stages if name in done])
+            if first == len(node_stages):
+                mark_provisioning([node], PROVISIONING_DONE)
+                ready.append(node)
+                continue
+            worker = Process(target=_run_node_stages_, args=(node, node_stages, semaphores, events, first))
+            worker.start()
+            running[node.id] = worker
+
+        try:
+            handle(events.get(timeout=1))
+        except Empty:
+            pass
+
+        for node_id, worker in running.items():
+            if not worker.is_alive():
+                worker.join()
+                del running[node_id]
+                # Collect whatever the worker reported before exiting, then check it reported its outcome
+                while True:
+                    try:
+                        handle(events.get_nowait())
+                    except Empty:
+                        break
+                if node_id not in failures and nodes_by_id[node_id] not in ready:
+                    failures[node_id] = (None, "Worker exited unexpectedly (exit code %s)" % worker.exitcode)
+                    error("%s: worker exited unexpectedly." % pretty_instance(nodes_by_id[node_id]))
+
+    env.pipeline_failures = failures
+    # Nodes decommissioned after timing out are no longer in the journal
+    mark_provisioning([nodes_by_id[node_id] for node_id in failures if node_id in nodes_by_id and node_id in checkpoints['nodes']], PROVISIONING_FAILED)
+    if failures or len(ready) < num:
+        warn("%d of %d node(s) did not complete provisioning. Use the resume task to continue from where this run stopped." % (num - len(ready), num))
+    else:
+        journal.finish(checkpoints)
+    use_only(*ready)
+    if ready and not env.parallel:
+        # Workers' SSH sessions die with them; open sessions for the serial tasks that follow in this process. Parallel
+        # ones would open their own anyway (see ssh.py).
+        from .ssh import prewarm
+        prewarm(ready)
+    return ready
+
+def _discard_timed_out_(checkpoints, nodes):
+    """Decommissions nodes that did not come up in time, as they are not named yet and nothing else would find them.
+    They are dropped from the journal, so resuming launches replacements."""
+    try:
+        decommission_nodes_async(nodes).result()
+    except (Exception, SystemExit), e:
+        error("Could not decommission node(s) %s that timed out: %s" % (", ".join([node.id for node in nodes]), e))
+        return
+    for node in nodes:
+        journal.forget(checkpoints, node.id)
+
+def _journaled_(checkpoints, f, *args):
+    """Calls a provider's launch function with checkpoints as the active journal, so the provider can record its launch
+    calls (and any key pair it creates) as it makes them."""
+    journal.activate(checkpoints)
+    try:
+        return f(*args)
+    finally:
+        journal.record_credentials(checkpoints)
+        journal.activate(None)
+
+def _as_stage_(stage, default_concurrency):
+    if callable(stage):
+        return (stage.__name__, _as_task_(stage), default_concurrency)
+    if len(stage) == 2:
+        return (stage[0], _as_task_(stage[1]), default_concurrency)
+    return (stage[0], _as_task_(stage[1]), stage[2])
+
+def _as_task_(f):
+    def stage():
+        execute(f)
+    return stage
+
+def _post_provision_():
+    if 'provider_post_provision_hook' in env:
+        env.provider_post_provision_hook()
+
+def _run_node_stages_(node, node_stages, semaphores, events, first = 0):
+    "Worker process body: runs all stages from index first onwards against a single node, reporting each outcome via events."
+    # Sessions inherited from the parent belong to it; never use them from here.
+    connections.clear()
+    use_only(node)
+    for index, (name, f, concurrency) in list(enumerate(node_stages))[first:]:
+        semaphores[index].acquire()
+        try:
+            f()
+        except (Exception, SystemExit), e:
+            # Fabric reports remote command failures by raising SystemExit
+            events.put((node.id, index, False, "%s: %s" % (type(e).__name__, e)))
+            return
+        finally:
+            semaphores[index].release()
+        events.put((node.id, index, True, None))
+
+def _adopt_(checkpoints):
+    """Looks up the instances an interrupted run launched. Returns (nodes that were provisioned and are running,
+    (node, sequential id) pairs still to be polled until running); lost instances are dropped from the journal."""
+    _find_unanswered_launches_(checkpoints)
+    ids = checkpoints['nodes'].keys()
+    if not ids:
+        return [], []
+    found = dict([(node.id, node) for node in instances_with_ids(ids)])
+    adopted = []
+    pending = []
+    for node_id in ids:
+        node = found.get(node_id)
+        state = getattr(node, 'state', 'running') if node else None
+        if state not in ('pending', 'running'):
+            warn("Node %s launched by the interrupted run is %s; a replacement will be launched." % (node_id, state or 'gone'))
+            journal.forget(checkpoints, node_id)
+        elif state == 'running' and PROVISIONED in journal.completed_stages(checkpoints, node_id):
+            adopted.append(node)
+        elif 'provider_poll_provisioning_function' in env:
+            pending.append((node, checkpoints['nodes'][node_id]['seq']))
+        else:
+            warn("Node %s launched by the interrupted run cannot be adopted; a replacement will be launched." % node_id)
+            journal.forget(checkpoints, node_id)
+    return adopted, pending
+
+def _find_unanswered_launches_(checkpoints):
+    """Records the instances of launch calls the interrupted run made but never saw return, found by client token."""
+    tokens = journal.unanswered_launch_requests(checkpoints)
+    if not tokens:
+        return
+    if 'provider_instances_by_client_token_function' not in env:
+        warn("%d launch call(s) of the interrupted run never returned and the provider cannot look up their instances; check for and decommission any left running." % len(tokens))
+        return
+    launched = env.provider_instances_by_client_token_function(tokens)
+    for token in tokens:
+        nodes = [node for node in launched if getattr(node, 'client_token', None) == token]
+        info("Launch call %s of the interrupted run launched %d instance(s)." % (token, len(nodes)))
+        journal.record_launch_result(token, nodes, checkpoints)
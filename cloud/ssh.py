@@ -0,0 +1,66 @@
+"""
+Helpers for managing the SSH sessions Fabric holds open to cloud nodes.
+
+Fabric caches one authenticated session per host string for the lifetime of the fab run, but opens them lazily and
+serially as each task first reaches each host. prewarm() opens sessions to all nodes concurrently up front (e.g. right
+after provisioning) so that every subsequent task, hook and execute() pass reuses them instead of paying for the
+handshake again. Sessions tunnelled through env.gateway are supported; the gateway session is opened first and shared.
+
+Only work done serially in this process benefits. Fabric discards the cached sessions in every process it forks for
+parallel execution (@parallel or -P, and so run_on_nodes, the provisioning pipeline's workers and synchronized_deploy),
+so each of those opens its own sessions, handshaking with every host again. Prewarm only ahead of serial tasks.
+"""
+from fabric.api import env
+from fabric.network import normalize_to_string
+from fabric.state import connections
+from . import host_string
+from .. import concurrently, debug, warn
+import time
+
+DEFAULT_KEEPALIVE_SECONDS = 30
+
+_handshakes_ = {} # host string -> seconds spent opening and authenticating the session
+
+def prewarm(nodes = None, pool_size = None):
+    """Concurrently opens and authenticates SSH sessions to the provided nodes, or env.nodes otherwise.
+    Hosts with an already cached session are skipped. Returns the list of host strings that could not be reached."""
+    nodes = env.nodes if nodes is None else nodes # Explicit None check because [] is False
+    if not env.keepalive:
+        # Stop idle sessions from being dropped by NAT devices or the gateway between tasks.
+        env.keepalive = DEFAULT_KEEPALIVE_SECONDS
+    keys = [normalize_to_string(host_string(node)) for node in nodes]
+    keys = [key for key in keys if key not in connections]
+    if not keys:
+        return []
+
+    if env.gateway and normalize_to_string(env.gateway) not in connections:
+        # Open the shared gateway session once, rather than racing to open it from every thread.
+        _open_(normalize_to_string(env.gateway))
+
+    failed = [key for key, result, e in concurrently(_open_, keys, pool_size or env.get('ssh_pool_size', 16)) if e]
+    if failed:
+        warn("Could not pre-open SSH sessions to %s" % ", ".join(failed))
+    debug("SSH sessions open to %d host(s). Handshake stats: %s" % (len(keys) - len(failed), handshake_stats()))
+    return failed
+
+def _open_(key):
+    start = time.time()
+    connections.connect(key)
+    _handshakes_[key] = time.time() - start
+
+def handshake_stats():
+    """Returns dict summarizing handshake latency (in seconds) of sessions opened by prewarm during this run."""
+    latencies = _handshakes_.values()
+    if not latencies:
+        return {'count': 0}
+    return {
+        'count': len(latencies),
+        'min': min(latencies),
+        'max': max(latencies),
+        'mean': sum(latencies) / len(latencies),
+        'total': sum(latencies)
+    }
+
+def handshake_latencies():
+    """Returns dict of host string -> handshake latency (in seconds) for sessions opened by prewarm."""
+    return dict(_handshakes_)
@@ -0,0 +1,216 @@
+"""
+Helpers for a blue/green provisioning strategy: a complete new (green) set of env.num_nodes nodes is provisioned in
+parallel next to the serving (blue) set, health-checked, and then swapped in as a whole, so the load balancer never
+mixes versions for longer than one register / deregister call. The blue set stays warm for a rollback window
+(bluegreen_rollback_window seconds, default 3600) so that rolling back is just as quick, after which the retire task
+decommissions it. Load-Balancer and Virtual IP modes are supported (the latter with a single node).
+
+Nodes are classified as:
+    LIVE        behind the load balancer / holding the virtual IP
+    STANDBY     previous live nodes kept warm after a cutover (tagged with the time they may be retired)
+    CANDIDATE   provisioned but never live: the green set awaiting cutover
+
+Settings:
+    provision_stages                stages new nodes go through before cutover (see fabulous.cloud.pipeline)
+    bluegreen_health_check          command run on each green node that must succeed before cutover
+    bluegreen_health_check_tries    attempts per node before the health gate fails (default 10, 6 seconds apart)
+    bluegreen_rollback_window       seconds the blue set is kept warm after cutover (default 3600)
+"""
+
+from fabric.api import env, execute, task, runs_once, run
+from fabric.colors import cyan,green,magenta
+from fabric.contrib.console import confirm
+from fabulous import error,info,warn
+from fabulous.cloud import decommission_nodes,id_of,instances_async,instances_with_platform_and_role,lb_add_nodes,lb_remove_nodes,lb_specified,live_nodes_async,provision_nodes,show,tag_nodes,use_inventory_cache,use_only,virtual_ip_assign,virtual_ip_specified
+from fabulous.config import configure
+from fabulous.executor import run_on_nodes
+import time
+
+LIVE,STANDBY,CANDIDATE = ['LIVE','STANDBY','CANDIDATE']
+MAX_ID = "MAX_ID"
+RETIRE_AFTER_TAG = 'fabulous:retire-after'
+
+@task(name="list")
+@runs_once
+def list_nodes():
+    """List all nodes by color."""
+    configure()
+    use_inventory_cache()
+    print("")
+    nodes = classify_nodes()
+    if nodes[CANDIDATE]:
+        print(magenta("** CANDIDATE nodes **"))
+        print(magenta("CANDIDATE nodes have been provisioned but never served. Use cutover to swap them in or discard to decommission them."))
+        show(nodes[CANDIDATE])
+    if nodes[STANDBY]:
+        print(cyan("** STANDBY nodes **"))
+        print(cyan("STANDBY nodes served before the last cutover and are kept warm for rollback. Use retire to decommission them once the window has passed."))
+        show(nodes[STANDBY])
+        for node in nodes[STANDBY]:
+            print(cyan("%s may be retired from %s" % (node.id, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(_retire_after_(node))))))
+        print("")
+    if nodes[LIVE]:
+        print(green("** LIVE nodes **"))
+        show(nodes[LIVE])
+    if not (nodes[LIVE] or nodes[STANDBY] or nodes[CANDIDATE]):
+        print(cyan("There are no nodes in the cluster."))
+
+@task(name="deploy")
+@runs_once
+def deploy():
+    """Provisions a complete green set of env.num_nodes nodes in parallel, then cuts over to it."""
+    configure()
+    _verify_mode_()
+    nodes = classify_nodes()
+    if nodes[CANDIDATE]:
+        error("There are already CANDIDATE nodes. Use cutover to swap them in or discard to decommission them first.")
+        return
+    if not _make_room_for_standby_(nodes):
+        return
+    provision_nodes(env.num_nodes, nodes[MAX_ID] + 1, stages=env.get('provision_stages'))
+    if len(env.nodes) < env.num_nodes:
+        error("Only %d of %d green node(s) could be provisioned; not cutting over. Use cutover or discard." % (len(env.nodes), env.num_nodes))
+        return
+    _cutover_(env.nodes, nodes[LIVE])
+
+@task(name="cutover")
+@runs_once
+def cutover():
+    """Health-checks the CANDIDATE nodes and swaps them in for the LIVE nodes."""
+    configure()
+    _verify_mode_()
+    nodes = classify_nodes()
+    if not nodes[CANDIDATE]:
+        info("There are no candidate nodes to cut over to.")
+        return
+    if not _make_room_for_standby_(nodes):
+        return
+    _cutover_(nodes[CANDIDATE], nodes[LIVE])
+
+@task(name="rollback")
+@runs_once
+def rollback():
+    """Swaps the most recent generation of STANDBY nodes back in for the LIVE nodes. The nodes rolled back from may be retired straight away."""
+    configure()
+    _verify_mode_()
+    nodes = classify_nodes()
+    if not nodes[STANDBY]:
+        error("There are no standby nodes to roll back to.")
+        return
+    # Nodes swapped out by the same cutover share their retire-after time; only the latest of those generations served last
+    latest = max([_retire_after_(node) for node in nodes[STANDBY]])
+    previous = [node for node in nodes[STANDBY] if _retire_after_(node) == latest]
+    _swap_(previous, nodes[LIVE])
+    tag_nodes(previous, {RETIRE_AFTER_TAG: ''})
+    if nodes[LIVE]:
+        tag_nodes(nodes[LIVE], {RETIRE_AFTER_TAG: str(int(time.time()))})
+    info("Rolled back to %d node(s)." % len(previous))
+
+@task(name="retire")
+@runs_once
+def retire(force = False):
+    """Decommissions STANDBY nodes whose rollback window has passed (all STANDBY nodes with force=true)."""
+    configure()
+    force = str(force).lower() in ("y","yes","t","true","1","on")
+    if not _retire_standby_(classify_nodes()[STANDBY], force):
+        info("There are no standby nodes to retire.")
+
+@task(name="discard")
+@runs_once
+def discard():
+    """Decommissions CANDIDATE nodes, e.g. after a failed health gate."""
+    configure()
+    use_only(*classify_nodes()[CANDIDATE])
+    if len(env.nodes) == 0:
+        info("There are no candidate nodes to discard.")
+    else:
+        show()
+        if confirm("Decommission these %d candidate node(s)?" % len(env.nodes), default=False):
+            decommission_nodes()
+
+def classify_nodes():
+    all_instances = instances_async()
+    live = live_nodes_async()
+    cluster_nodes = instances_with_platform_and_role(env.platform, env.role, all_instances.result())
+    # max gets grumpy if only 1 argument. Hence two zeros to handle case when cluster is empty.
+    max_seq_number = max(0, 0, *[id_of(node) for node in cluster_nodes])
+    live_ids = set([node.id for node in live.result() or []])
+
+    nodes = {LIVE: [], STANDBY: [], CANDIDATE: [], MAX_ID: max_seq_number}
+    for node in sorted(cluster_nodes, key = id_of):
+        if node.id in live_ids:
+            nodes[LIVE].append(node)
+        elif node.tags.get(RETIRE_AFTER_TAG):
+            nodes[STANDBY].append(node)
+        else:
+            nodes[CANDIDATE].append(node)
+    return nodes
+
+def _verify_mode_():
+    if not (lb_specified() or virtual_ip_specified()):
+        error("The blue/green strategy requires a load balancer or virtual IP to swap.")
+        raise SystemExit(1)
+    if not 'provider_tag_nodes_function' in env:
+        error("The blue/green strategy requires a provider that supports tagging nodes.")
+        raise SystemExit(1)
+    if virtual_ip_specified() and env.num_nodes != 1:
+        error("With a virtual IP, the blue/green strategy supports a single node only (num_nodes=1).")
+        raise SystemExit(1)
+
+def _retire_standby_(standby, force = False):
+    """Decommissions those standby nodes whose rollback window has passed (all of them if force). Returns the number
+    decommissioned."""
+    due = [node for node in standby if force or _retire_after_(node) <= time.time()]
+    if len(due) < len(standby):
+        info("%d standby node(s) are still within the rollback window." % (len(standby) - len(due)))
+    if due:
+        use_only(*due)
+        decommission_nodes()
+    return len(due)
+
+def _make_room_for_standby_(nodes):
+    """A cutover makes the LIVE nodes the STANDBY generation, so rollback always has a single generation to return to.
+    Retires standby nodes whose window has passed; returns False if any are still within it."""
+    _retire_standby_(nodes[STANDBY])
+    waiting = [node for node in nodes[STANDBY] if _retire_after_(node) > time.time()]
+    if waiting:
+        error("%d STANDBY node(s) from the previous cutover are still within the rollback window. Use rollback, or retire:force=true to give up on rolling back to them." % len(waiting))
+        return False
+    return True
+
+def _retire_after_(node):
+    return int(node.tags.get(RETIRE_AFTER_TAG) or 0)
+
+def _cutover_(green_nodes, blue_nodes):
+    if not _health_gate_(green_nodes):
+        error("Green node(s) failed the health gate; not cutting over. Use discard to decommission them.")
+        return
+    _swap_(green_nodes, blue_nodes)
+    if blue_nodes:
+        window = int(env.get('bluegreen_rollback_window', 3600))
+        tag_nodes(blue_nodes, {RETIRE_AFTER_TAG: str(int(time.time()) + window)})
+        info("Previous node(s) kept warm for rollback for %d seconds; use retire to decommission them afterwards." % window)
+
+def _health_gate_(nodes):
+    if not env.get('bluegreen_health_check'):
+        warn("No bluegreen_health_check configured; cutting over without a health gate.")
+        return True
+    info("Health-checking %d green node(s)." % len(nodes))
+    results = run_on_nodes(run, env.bluegreen_health_check, nodes=nodes, pool_size=len(nodes),
+                           tries=int(env.get('bluegreen_health_check_tries', 10)), retry_delay_seconds=6)
+    return not results.failed()
+
+def _swap_(add, remove):
+    """Puts add behind the load balancer / virtual IP and takes remove out, with one call each."""
+    if lb_specified():
+        use_only(*add)
+        lb_add_nodes()
+        if remove:
+            use_only(*remove)
+            lb_remove_nodes()
+    else:
+        # Assigning a secondary IP configures the node itself, so needs to run against it
+        use_only(add[0])
+        execute(virtual_ip_assign)
+    use_only(*add)
+    info("Now serving from %d node(s)." % len(add))
@@ -2,26 +2,40 @@
 Helpers for a rolling provisioning strategy in which new deployments go to new hosts rather than being applied in-place
 to existing ones. This strategy uses a target cluster size and a first-in-first-out strategy based on sequential node
 ids. Three operating modes are supported: Simple, Virtual IP, and Load-Balancer.
+
+In Simple and Load-Balancer modes, the autoscale task can drive the target cluster size from a load metric. The
+reconcile task keeps the cluster at its target size, replacing lost nodes without an operator.
 """
 
-from fabric.api import env, task, runs_once
+from fabric.api import env, execute, task, runs_once
 from fabric.colors import cyan,green,magenta,red
 from fabric.contrib.console import confirm
-from fabulous import debug,info,retry
-from fabulous.cloud import decommission_nodes,id_of,instances_with_platform_and_role,lb_add_nodes,lb_get_nodes,lb_remove_nodes,lb_specified,provision_nodes,show,use,use_only,virtual_ip_get_node,virtual_ip_specified
+from fabulous import cache_directory,debug,error,info,retry,submit,warn
+from fabulous.cloud import PROVISIONING_FAILED,decommission_nodes,decommission_nodes_async,fresh_nodes,id_of,instances_async,instances_with_ids,is_provisioned,instances_with_platform_and_role,lb_add_nodes,lb_add_nodes_async,lb_remove_nodes,lb_remove_nodes_async,lb_specified,live_nodes_async,mark_provisioning,pretty_instances,provision_nodes,provisioning_failed,resume_provisioning,show,use,use_inventory_cache,use_only,virtual_ip_assign,virtual_ip_specified,with_version
+from fabulous.cloud import journal
 from fabulous.config import configure
+from fabulous.metrics import read_metric
+from os import path
+import json
+import math
+import time
 
 ACTIVE,EXTRA,INACTIVE,ORPHAN = ['ACTIVE','EXTRA','INACTIVE','ORPHAN']
+FAILED = 'FAILED'
 MAX_ID = "MAX_ID"
 
 @task(name="list")
 @runs_once
-def list_nodes():
-    """List all nodes."""
+def list_nodes(version = None):
+    """List all nodes, or only those running version (Git SHA or artifact digest prefix) if specified."""
     configure()
+    use_inventory_cache()
     print("")
 
-    nodes = classify_nodes()
+    nodes = classify_nodes(version)
+
+    if journal.load():
+        print(red("A provision run was interrupted. To continue it, adopting the nodes it launched, use the resume task."))
 
     if nodes[INACTIVE]:
         print("")
@@ -81,7 +95,17 @@ def provision():
     """Provisions env.num_nodes new nodes."""
     configure()
     use_only()
-    env.new_nodes = provision_nodes(env.num_nodes, classify_nodes()[MAX_ID] + 1)
+    env.new_nodes = provision_nodes(env.num_nodes, classify_nodes()[MAX_ID] + 1, stages=env.get('provision_stages'))
+
+@task(name="resume")
+@runs_once
+def resume():
+    """Resumes an interrupted provision run from its checkpoint, adopting the nodes it already launched."""
+    configure()
+    use_only()
+    env.new_nodes = resume_provisioning(stages=env.get('provision_stages'))
+    if env.new_nodes is None:
+        info("There is no interrupted provision run to resume.")
 
 @task(name="prune")
 @runs_once
@@ -124,20 +148,29 @@ def _sort_nodes_(nodes):
 #def all_nodes():
 #    return _sort_nodes_(instances_with_platform_and_role(env.platform, env.role))
 
-def classify_nodes():
+def classify_nodes(version = None, settled_only = False):
+    """Classifies cluster nodes as ACTIVE, EXTRA, INACTIVE or ORPHAN. If version is given, only nodes recorded as
+    running it (see cloud.tag_deployed_version) are returned; classification itself still considers all nodes.
+    If settled_only, nodes not behind the load balancer / virtual IP that are still being provisioned (see
+    cloud.is_provisioned) are left out entirely, so runs provisioning them are not interfered with, and those that
+    failed to be are classified as FAILED rather than as any of the above."""
     # Confusion warning: node.id is platform-role-unique_identifier, id_of(node) is unique_identifier.
     # For rolling strategy, unique identifers are sequential
-    cluster_nodes = instances_with_platform_and_role(env.platform, env.role)
-    cluster_node_ids = set([node.id for node in cluster_nodes])
+    # Enumerating instances and fetching load balancer / virtual IP membership are independent; overlap them.
+    all_instances = instances_async()
+    live = live_nodes_async()
+    cluster_nodes = instances_with_platform_and_role(env.platform, env.role, all_instances.result())
     # max gets grumpy if only 1 argument. Hence two zeros to handle case when cluster is empty.
     max_seq_number = max(0, 0, *[id_of(node) for node in cluster_nodes])
 
-    if lb_specified():
-        live_nodes = lb_get_nodes()
-    elif virtual_ip_specified():
-        node = virtual_ip_get_node()
-        live_nodes = [node] if node else []
-    else:
+    live_nodes = live.result()
+    failed_nodes = []
+    if settled_only:
+        live_ids = set([node.id for node in live_nodes or []])
+        failed_nodes = [node for node in cluster_nodes if node.id not in live_ids and provisioning_failed(node)]
+        cluster_nodes = [node for node in cluster_nodes if node.id in live_ids or is_provisioned(node)]
+    cluster_node_ids = set([node.id for node in cluster_nodes])
+    if live_nodes is None:
         live_nodes = cluster_nodes
     live_node_ids = set([node.id for node in live_nodes])
     live_nodes_not_in_cluster = [node for node in live_nodes if not node.id in cluster_node_ids]
@@ -180,38 +213,305 @@ def classify_nodes():
             else:
                 inactive_nodes.append(node)
 
+    matching = (lambda nodes: with_version(nodes, version)) if version else (lambda nodes: nodes)
     return {
-        ACTIVE : [node for node in reversed(active_nodes)],
-        EXTRA : [node for node in reversed(extra_nodes)],
-        INACTIVE : [node for node in reversed(inactive_nodes)],
-        ORPHAN : [node for node in reversed(orphan_nodes)],
+        ACTIVE : matching([node for node in reversed(active_nodes)]),
+        EXTRA : matching([node for node in reversed(extra_nodes)]),
+        INACTIVE : matching([node for node in reversed(inactive_nodes)]),
+        ORPHAN : matching([node for node in reversed(orphan_nodes)]),
+        FAILED : matching(failed_nodes),
         MAX_ID : max_seq_number
     }
 
 @task(name="active")
 @runs_once
-def use_active_nodes():
-    """Operate on active nodes: current per cluster id sequence, behind load balancer / virtual IP."""
-    for node in classify_nodes()[ACTIVE]:
+def use_active_nodes(version = None):
+    """Operate on active nodes: current per cluster id sequence, behind load balancer / virtual IP. Optionally only those running version."""
+    use_inventory_cache()
+    for node in fresh_nodes(classify_nodes(version)[ACTIVE]):
         use(node)
 
 @task(name="extra")
 @runs_once
-def use_extra_nodes():
-    """Operate on extra nodes: not current per cluster id sequence, but behind load balancer."""
-    for node in classify_nodes()[EXTRA]:
+def use_extra_nodes(version = None):
+    """Operate on extra nodes: not current per cluster id sequence, but behind load balancer. Optionally only those running version."""
+    use_inventory_cache()
+    for node in fresh_nodes(classify_nodes(version)[EXTRA]):
         use(node)
 
 @task(name="inactive")
 @runs_once
-def use_inactive_nodes():
-    """Operate on inactive nodes: not current per cluster id sequence, not behind load balancer / virtual IP."""
-    for node in classify_nodes()[INACTIVE]:
+def use_inactive_nodes(version = None):
+    """Operate on inactive nodes: not current per cluster id sequence, not behind load balancer / virtual IP. Optionally only those running version."""
+    use_inventory_cache()
+    for node in fresh_nodes(classify_nodes(version)[INACTIVE]):
         use(node)
 
 @task(name="orphan")
 @runs_once
-def use_orphan_nodes():
-    """Operate on orphan nodes: current per cluster id sequence, but not behind load balancer / virtual IP."""
-    for node in classify_nodes()[ORPHAN]:
+def use_orphan_nodes(version = None):
+    """Operate on orphan nodes: current per cluster id sequence, but not behind load balancer / virtual IP. Optionally only those running version."""
+    use_inventory_cache()
+    for node in fresh_nodes(classify_nodes(version)[ORPHAN]):
         use(node)
+
+## ------------------ Autoscaling -----------------------
+# Settings:
+#   autoscale_metric_source            where to read load from; see fabulous.metrics. Required.
+#   autoscale_load_per_node            load one node should carry. Required.
+#   autoscale_min_nodes / _max_nodes   bounds on cluster size (default 1 / 20)
+#   autoscale_hysteresis               fraction load per node must stray from autoscale_load_per_node before resizing
+#                                      (default 0.2)
+#   autoscale_scale_up_cooldown        seconds after any resize before scaling up again (default 300)
+#   autoscale_scale_down_cooldown      seconds after any resize before scaling down again (default 900)
+#   autoscale_interval                 seconds between checks when looping (default 60)
+#   provision_stages                   stages new nodes go through before serving (see fabulous.cloud.pipeline)
+# The size last scaled to is recorded locally along with the time, to apply cooldowns across fab invocations.
+
+@task(name="autoscale")
+@runs_once
+def autoscale(loop = False):
+    """Resizes the cluster to follow the load metric. Pass loop=true to keep doing so every autoscale_interval seconds."""
+    configure()
+    if virtual_ip_specified():
+        warn("Autoscaling is not supported with a virtual IP, as only one node can serve.")
+        return
+    while True:
+        _autoscale_once_()
+        if str(loop).lower() not in ("y","yes","t","true","1","on"):
+            return
+        time.sleep(int(env.get('autoscale_interval', 60)))
+
+def autoscale_target(load, current):
+    """Returns the cluster size to converge to for the given load and current number of active nodes, honoring
+    hysteresis and the min / max bounds (but not cooldowns)."""
+    per_node = float(env.autoscale_load_per_node)
+    hysteresis = float(env.get('autoscale_hysteresis', 0.2))
+    min_nodes = int(env.get('autoscale_min_nodes', 1))
+    max_nodes = int(env.get('autoscale_max_nodes', 20))
+    desired = int(math.ceil(load / per_node))
+    load_per_current_node = load / max(current, 1)
+    if desired > current and load_per_current_node > per_node * (1 + hysteresis):
+        target = desired
+    elif desired < current and load_per_current_node < per_node * (1 - hysteresis):
+        target = desired
+    else:
+        target = current
+    return max(min_nodes, min(max_nodes, target))
+
+def _autoscale_once_():
+    load = read_metric(env.autoscale_metric_source)
+    history = _autoscale_history_()
+    # Classify against the size autoscaling last converged to, rather than the static num_nodes setting
+    env.num_nodes = target_size(env.num_nodes)
+    # Nodes still being provisioned (or that failed to be) must be neither put behind the load balancer as ORPHANs nor
+    # counted towards the size
+    current = len(classify_nodes(settled_only=True)[ACTIVE])
+    if load is None:
+        warn("No value for load metric; leaving cluster at %d node(s)." % current)
+        return
+    target = autoscale_target(load, current)
+    since_last = time.time() - history.get('time', 0)
+    if target > current and since_last < int(env.get('autoscale_scale_up_cooldown', 300)):
+        info("Load %.2f calls for %d node(s), but scale-up cooldown is in effect (last resize %ds ago)." % (load, target, since_last))
+        target = current
+    elif target < current and since_last < int(env.get('autoscale_scale_down_cooldown', 900)):
+        info("Load %.2f calls for %d node(s), but scale-down cooldown is in effect (last resize %ds ago)." % (load, target, since_last))
+        target = current
+
+    env.num_nodes = target
+    nodes = classify_nodes(settled_only=True)
+    shortfall = target - len(nodes[ACTIVE]) - len(nodes[ORPHAN])
+    if target == current and shortfall <= 0 and not nodes[EXTRA]:
+        debug("Load %.2f; cluster stays at %d node(s)." % (load, current))
+        return
+
+    info("Load %.2f; resizing cluster from %d to %d node(s)." % (load, current, target))
+    # Orphans go back behind the load balancer while new nodes are being provisioned
+    orphans_added = lb_add_nodes_async(nodes[ORPHAN]) if nodes[ORPHAN] and lb_specified() else None
+    if shortfall > 0:
+        provision_nodes(shortfall, nodes[MAX_ID] + 1, stages=env.get('provision_stages'),
+                        on_node_ready=_add_to_lb_ if lb_specified() else None)
+    if orphans_added:
+        orphans_added.result()
+    if nodes[EXTRA]:
+        use_only(*nodes[EXTRA])
+        lb_remove_nodes()
+    if target != current:
+        _record_autoscale_(target)
+
+def _add_to_lb_(node):
+    use_only(node)
+    lb_add_nodes()
+
+def target_size(configured):
+    """Returns the cluster size autoscale last converged to, if it has run for this platform and role, otherwise
+    configured (normally num_nodes). Autoscale and reconcile both converge to it, so they agree on one size."""
+    return _autoscale_history_().get('target', configured)
+
+def _autoscale_history_path_():
+    return path.join(cache_directory('autoscale'), "%s-%s.json" % (env.platform, env.role))
+
+def _autoscale_history_():
+    if not path.exists(_autoscale_history_path_()):
+        return {}
+    with open(_autoscale_history_path_()) as f:
+        return json.load(f)
+
+def _record_autoscale_(target):
+    with open(_autoscale_history_path_(), 'w') as f:
+        json.dump({'target': target, 'time': time.time()}, f)
+
+## ------------------ Reconciling -----------------------
+# The reconcile task keeps the cluster at its target size of ACTIVE nodes: num_nodes, or the size autoscale last
+# converged to if it runs too (see target_size). Each pass classifies the cluster afresh from the provider, logs what
+# changed since the previous pass, and plans the fewest actions that close the gap: re-adding ORPHAN nodes, provisioning
+# the remaining shortfall, taking EXTRA nodes out of the load balancer and decommissioning INACTIVE and FAILED ones. Independent actions run concurrently. Nodes still being provisioned by any run are left alone, and
+# nothing is done while this machine has a provision run in progress. A run that is no longer in progress but did not
+# complete is taken over rather than left for the resume task: the nodes it left unfinished are decommissioned and
+# replaced like FAILED ones, and its journal is removed.
+# Settings:
+#   reconcile_interval                 seconds between passes when looping (default 60)
+#   provision_stages                   stages new nodes go through before serving (see fabulous.cloud.pipeline)
+# How long each kind of action took is recorded locally, to estimate the duration of later plans.
+
+PROVISION, LB_ADD, LB_REMOVE, DECOMMISSION, VIP_ASSIGN = ['provision', 'lb_add', 'lb_remove', 'decommission', 'virtual_ip_assign']
+DEFAULT_ACTION_SECONDS = {PROVISION: 300, LB_ADD: 10, LB_REMOVE: 10, DECOMMISSION: 15, VIP_ASSIGN: 10}
+
+@task(name="reconcile")
+@runs_once
+def reconcile(loop = False, dry_run = False):
+    """Brings the cluster to its target size (num_nodes, or the size autoscale last converged to) of ACTIVE nodes with the fewest actions. Pass dry_run=true to only print the plan and its estimated duration, loop=true to keep reconciling every reconcile_interval seconds."""
+    configure()
+    dry_run = str(dry_run).lower() in ("y","yes","t","true","1","on")
+    configured = env.num_nodes
+    previous = None
+    while True:
+        # Follows the size autoscale converged to, if it runs too, rather than undoing its resizes
+        env.num_nodes = target_size(configured)
+        checkpoints = journal.load()
+        if checkpoints and journal.in_progress(checkpoints):
+            warn("A provision run is in progress; not reconciling until it completes.")
+        else:
+            # Acts on live provider objects rather than the inventory cache, as e.g. assigning a secondary IP needs them
+            nodes = classify_nodes(settled_only=True)
+            if checkpoints:
+                nodes[FAILED] = _take_over_(checkpoints, nodes[FAILED], dry_run)
+            _log_changes_(previous, nodes)
+            previous = nodes
+            plan = reconcile_plan(nodes)
+            if not plan:
+                debug("Cluster is at its target size of %d node(s); nothing to do." % env.num_nodes)
+            else:
+                _show_plan_(plan)
+                if not dry_run:
+                    _execute_plan_(plan, nodes[MAX_ID])
+        if str(loop).lower() not in ("y","yes","t","true","1","on"):
+            return
+        time.sleep(int(env.get('reconcile_interval', 60)))
+
+def reconcile_plan(nodes):
+    """Returns the list of (action, nodes or number of nodes) taking the classified nodes to env.num_nodes ACTIVE ones
+    (reconcile sets it to the target size first)."""
+    plan = []
+    if nodes[ORPHAN]:
+        if lb_specified():
+            plan.append((LB_ADD, nodes[ORPHAN]))
+        elif virtual_ip_specified():
+            plan.append((VIP_ASSIGN, nodes[ORPHAN][:1]))
+    shortfall = env.num_nodes - len(nodes[ACTIVE]) - len(nodes[ORPHAN])
+    if shortfall > 0:
+        plan.append((PROVISION, shortfall))
+    if nodes[EXTRA]:
+        plan.append((LB_REMOVE, nodes[EXTRA]))
+    if nodes[INACTIVE] or nodes.get(FAILED):
+        plan.append((DECOMMISSION, nodes[INACTIVE] + nodes.get(FAILED, [])))
+    return plan
+
+def _take_over_(checkpoints, failed, dry_run):
+    """Returns failed plus the nodes a provision run that did not complete left unfinished, so they are decommissioned
+    and replaced. Unless dry_run, those are tagged as failed (so later passes still find them) and the run's journal is
+    removed."""
+    failed_ids = set([node.id for node in failed])
+    unfinished = [node for node in instances_with_ids(checkpoints['nodes'].keys())
+                  if node.id not in failed_ids and getattr(node, 'state', 'running') in ('pending', 'running')
+                  and not (is_provisioned(node) and (node.tags or {}).get("Name"))]
+    warn("Taking over from a provision run that did not complete; replacing %d node(s) it left unfinished." % len(unfinished))
+    if not dry_run:
+        mark_provisioning(unfinished, PROVISIONING_FAILED)
+        journal.finish(checkpoints)
+    return failed + unfinished
+
+def estimated_seconds(plan):
+    """Estimated duration of plan: load balancer changes and decommissioning run alongside assigning the virtual IP
+    and provisioning, which run one after the other."""
+    durations = _action_durations_()
+    concurrent = [durations[action] for action, target in plan if action in (LB_ADD, LB_REMOVE, DECOMMISSION)]
+    sequential = [durations[action] for action, target in plan if action in (VIP_ASSIGN, PROVISION)]
+    return max([0, sum(sequential)] + concurrent)
+
+def _log_changes_(previous, nodes):
+    if previous is None:
+        return
+    classes = [ACTIVE, EXTRA, INACTIVE, ORPHAN, FAILED]
+    before = dict([(node.id, cls) for cls in classes for node in previous[cls]])
+    after = dict([(node.id, cls) for cls in classes for node in nodes[cls]])
+    for node_id in sorted(set(before) | set(after)):
+        if before.get(node_id) != after.get(node_id):
+            info("%s: %s -> %s" % (node_id, before.get(node_id, 'new'), after.get(node_id, 'gone')))
+
+def _show_plan_(plan):
+    print(cyan("Reconcile plan for %d node(s), estimated %ds:" % (env.num_nodes, estimated_seconds(plan))))
+    for action, target in plan:
+        print(cyan("  %s %s" % (action, "%d node(s)" % target if action == PROVISION else pretty_instances(target))))
+
+def _execute_plan_(plan, max_id):
+    # Load balancer changes and decommissioning name their nodes explicitly, so they can proceed while the virtual IP
+    # is assigned and new nodes are provisioned here.
+    started = []
+    for action, target in plan:
+        if action == LB_ADD:
+            started.append((action, submit(_timed_, lb_add_nodes_async, target)))
+        elif action == LB_REMOVE:
+            started.append((action, submit(_timed_, lb_remove_nodes_async, target)))
+        elif action == DECOMMISSION:
+            started.append((action, submit(_timed_, decommission_nodes_async, target)))
+    for action, target in plan:
+        start = time.time()
+        if action == VIP_ASSIGN:
+            # Assigning a secondary IP configures the node itself, so needs to run against it
+            use_only(*target)
+            execute(virtual_ip_assign)
+        elif action == PROVISION:
+            provision_nodes(target, max_id + 1, stages=env.get('provision_stages'),
+                            on_node_ready=_add_to_lb_ if lb_specified() else None)
+        else:
+            continue
+        _record_action_(action, time.time() - start)
+    for action, future in started:
+        try:
+            _record_action_(action, future.result())
+        except (Exception, SystemExit), e:
+            error("Reconcile action %s failed: %s" % (action, e))
+
+def _timed_(start_action, target):
+    start = time.time()
+    start_action(target).result()
+    return time.time() - start
+
+def _action_durations_path_():
+    return path.join(cache_directory('reconcile'), "%s-%s.json" % (env.platform, env.role))
+
+def _action_durations_():
+    durations = dict(DEFAULT_ACTION_SECONDS)
+    if path.exists(_action_durations_path_()):
+        with open(_action_durations_path_()) as f:
+            durations.update(json.load(f))
+    return durations
+
+def _record_action_(action, seconds):
+    durations = _action_durations_()
+    # Moving average, so one unusually slow run does not dominate the estimate
+    durations[action] = 0.7 * durations[action] + 0.3 * seconds
+    with open(_action_durations_path_(), 'w') as f:
+        json.dump(durations, f)
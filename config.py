@@ -9,6 +9,8 @@ def configure():
     All config keys listed in env.ints have their values converted to ints.
     env.provider_config_functions are tried until one succeeds or fails. E.g. env.provider_config_functions = [aws_config, gce_config]
     If a provider_config_function reports that it is selected but failed, sys.exit(1)
+    If env.providers lists several providers (e.g. "ec2,google_compute_engine"), all of them are configured and used
+    together; see fabulous.cloud.hybrid.
     """
     if env.get("configured") is None:
         if not "defaults" in env:
@@ -19,22 +21,18 @@ def configure():
             env.ints = []
         env.ints.append('num_nodes')
         env.ints.append('provisioning_timeout')
+        env.defaults['inventory_cache_ttl'] = 3600
+        env.ints.append('inventory_cache_ttl')
+        if not "bools" in env:
+            env.bools = []
+        env.bools.append('inventory_cache')
         _apply_defaults_()
         env.configured = False
-        if env.provider_config_functions and len(env.provider_config_functions) > 0:
-            for f in env.provider_config_functions:
-                result = f()
-                if result is None:
-                    # try another provider
-                    pass
-                elif result:
-                    # successfully configured this provider
-                    env.configured = True
-                    break
-                else:
-                    # This provider was selected, but configuration failed.
-                    # Error should have already been logged by provider_config_function.
-                    sys.exit(1)
+        if env.get('providers'):
+            from .cloud.hybrid import configure_providers
+            env.configured = configure_providers([name.strip() for name in env.providers.split(',') if name.strip()])
+        else:
+            env.configured = _configure_provider_()
 
         if not env.configured:
             warn("No cloud provider config functions were supplied via env.provider_config_functions and/or no provider was selected via env.provider")
@@ -44,6 +42,23 @@ def configure():
             env.group = env.user
         return True
 
+def _configure_provider_():
+    "Tries env.provider_config_functions in turn. Returns True if one succeeded, False if none was selected."
+    if env.provider_config_functions and len(env.provider_config_functions) > 0:
+        for f in env.provider_config_functions:
+            result = f()
+            if result is None:
+                # try another provider
+                pass
+            elif result:
+                # successfully configured this provider
+                return True
+            else:
+                # This provider was selected, but configuration failed.
+                # Error should have already been logged by provider_config_function.
+                sys.exit(1)
+    return False
+
 def _apply_defaults_():
     "Apply default values for optional settings"
     if "defaults" in env:
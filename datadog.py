@@ -4,22 +4,41 @@ from fabric.contrib.files import sed
 from fabric.operations import sudo
 from fabulous import debug, error, git, info, retry
 from fabulous.config import verify_env_contains_keys
+from fabulous.debian import install_bundle
+from fabulous.state import applied_step
 from fabulous.cloud import pretty_instance, current_node
+import json
 import re
+import time
+import urllib
+import urllib2
 
 def is_datadog_enabled():
     return 'datadog_api_key' in env and env.datadog_api_key
 
+@applied_step(inputs=lambda datadog_api_key = None, bundle_dir = None: [get_datadog_api_key(datadog_api_key), bundle_dir or env.get('datadog_bundle_dir')])
 @retry(SystemExit)
-def install_datadog_agent(datadog_api_key = None):
+def install_datadog_agent(datadog_api_key = None, bundle_dir = None):
     """
     Installs the Datadog agent.
     :param datadog_api_key: interpreted via get_datadog_api_key
+    :param bundle_dir: package bundle (see fabulous.debian.build_bundle) containing datadog-agent, built on a seed
+        node with Datadog's apt source configured. Defaults to env.datadog_bundle_dir. If neither is set, the install
+        script is fetched from Datadog and run on the node.
     """
+    bundle_dir = bundle_dir or env.get('datadog_bundle_dir')
+    if bundle_dir:
+        info("Installing Datadog agent from package bundle %s." % bundle_dir)
+        install_bundle(bundle_dir)
+        sudo('cp -n /etc/dd-agent/datadog.conf.example /etc/dd-agent/datadog.conf')
+        sed('/etc/dd-agent/datadog.conf', '^api_key:.*', 'api_key: %s' % get_datadog_api_key(datadog_api_key), use_sudo=True)
+        sudo('service datadog-agent restart')
+        return
     info("Installing Datadog agent.")
     # Per https://app.datadoghq.com/account/settings#agent/ubuntu
     sudo('DD_API_KEY=%s bash -c "$(wget -qO- http://dtdg.co/agent-install-ubuntu)"' % get_datadog_api_key(datadog_api_key))
 
+@applied_step(inputs=lambda dd_hostname = None, datadog_tags = None: [dd_hostname or current_node().tags.get("Name"), get_datadog_tags(datadog_tags)])
 @retry(SystemExit,total_tries = 8)
 def add_datadog_agent_tags(dd_hostname = None, datadog_tags = None):
     """
@@ -69,3 +88,26 @@ def get_datadog_tags(datadog_tags = None):
     if datadog_tags == '':
         datadog_tags = []
     return re.split('[, ]', datadog_tags) if isinstance(datadog_tags, basestring) else datadog_tags
+
+def query_metric(query, window_seconds = 300, datadog_api_key = None, datadog_application_key = None):
+    """
+    Returns the mean of the points reported for a Datadog metric query over the last window_seconds, or None if there
+    are none. Aggregate within the query itself, e.g. "avg:system.load.1{role:web}".
+    :param datadog_api_key: interpreted via get_datadog_api_key
+    :param datadog_application_key: defaults to env.datadog_application_key
+    """
+    if not datadog_application_key:
+        verify_env_contains_keys('datadog_application_key')
+        datadog_application_key = env.datadog_application_key
+    now = int(time.time())
+    params = urllib.urlencode({
+        'api_key': get_datadog_api_key(datadog_api_key),
+        'application_key': datadog_application_key,
+        'from': now - window_seconds,
+        'to': now,
+        'query': query
+    })
+    response = json.load(urllib2.urlopen('https://app.datadoghq.com/api/v1/query?%s' % params, timeout=30))
+    values = [point[1] for series in response.get('series', []) for point in series.get('pointlist', []) if point[1] is not None]
+    debug("Datadog query %s returned %d point(s)" % (query, len(values)))
+    return sum(values) / len(values) if values else None
@@ -1,12 +1,129 @@
+from fabric.api import env, get, local, put, run, settings
 from fabric.operations import sudo
-from fabulous import retry
+from fabulous import cache_directory, debug, fingerprint, info, retry
+from fabulous.state import applied_step
+from os import path
+import json
+import os
+import time
 
+@applied_step()
 @retry(SystemExit) # Oddly on AWS EC2 this sometimes fails on the first try
 def install_packages(*packages):
     sudo('apt-get -qq --yes update')
     sudo('DEBIAN_FRONTEND=noninteractive apt-get -qq --yes install %s'  % (" ".join(packages)))
 
+# Upgrades at most once per upgrade_system_every_days (default 1) on each host, as the packages available change over time
+@applied_step(inputs=lambda: int(time.time() / (86400 * float(env.get('upgrade_system_every_days', 1)))))
 def upgrade_system():
     # --force-confnew, --force-confold: When config file updated, prefer new/old version
     # --force-confdef: if a default selection is specified for the package, allow it to trump
     sudo('DEBIAN_FRONTEND=noninteractive apt-get -qq --yes -o Dpkg::Options::="--force-confdef" -o Dpkg::Options::="--force-confnew" upgrade')
+
+# -------------- Offline package bundles ------------------
+# A bundle is a directory on the control machine holding every .deb needed to install a set of packages (dependencies
+# included), a bundle.lock manifest recording exactly which package versions it contains, and a SHA256SUMS file.
+# It is resolved and downloaded once, then pushed to each node and installed with dpkg, so nodes never touch a mirror.
+
+BUNDLE_MANIFEST = 'bundle.lock'
+BUNDLE_CHECKSUMS = 'SHA256SUMS'
+REMOTE_BUNDLE_PARENT = '/var/cache/fabulous/debs'
+
+# Prints "<sha256> <package> <version> <file>" per downloaded .deb, then "DIR <download directory>"
+_RESOLVE_SCRIPT_ = """set -e
+dir=$(mktemp -d /tmp/fabulous-debs.XXXXXX)
+cd $dir
+apt-get download $(apt-cache depends --recurse --no-recommends --no-suggests --no-conflicts --no-breaks --no-replaces --no-enhances %s | grep '^[a-z0-9]' | sort -u) > /dev/null
+for f in *.deb; do echo "$(sha256sum $f | cut -d' ' -f1) $(dpkg-deb --show --showformat='${Package} ${Version}' $f) $f"; done
+echo "DIR $dir"
+"""
+
+def build_bundle(*packages, **kwargs):
+    """Resolves packages and their full dependency closure once, and downloads the .debs into a bundle directory on the
+    control machine. Returns the bundle directory. An existing bundle for the same package set is reused as-is; delete
+    it (or pass refresh=True) to pick up newer versions.
+    :param seed_host: host to resolve and download on (must match the nodes' distribution and apt sources, e.g. a node
+        already provisioned from the same AMI). Defaults to env.debian_bundle_seed_host, else the control machine.
+    :param bundle_dir: defaults to a directory under the fabulous cache keyed by the package set. Must be empty or hold
+        a bundle already, as rebuilding replaces the .debs in it
+    :param refresh: rebuild even if a bundle already exists
+    """
+    seed_host = kwargs.get('seed_host') or env.get('debian_bundle_seed_host')
+    bundle_dir = kwargs.get('bundle_dir') or cache_directory('debs', fingerprint(sorted(packages))[:12])
+    manifest = read_bundle_manifest(bundle_dir)
+    if manifest and not kwargs.get('refresh') and sorted(manifest['requested']) == sorted(packages):
+        debug("Using existing package bundle %s (%d .debs)" % (bundle_dir, len(manifest['debs'])))
+        return bundle_dir
+    if not path.isdir(bundle_dir):
+        os.makedirs(bundle_dir)
+    elif os.listdir(bundle_dir) and not path.exists(path.join(bundle_dir, BUNDLE_MANIFEST)):
+        raise RuntimeError("%s is not empty and holds no package bundle; not building one there." % bundle_dir)
+
+    info("Resolving package bundle for %s on %s" % (" ".join(packages), seed_host or "control machine"))
+    script = _RESOLVE_SCRIPT_ % " ".join(packages)
+    if seed_host:
+        with settings(host_string=seed_host):
+            sudo('apt-get -qq --yes update')
+            output = run(script, quiet=True)
+    else:
+        output = local(script, capture=True)
+
+    debs = []
+    download_dir = None
+    for line in output.splitlines():
+        fields = line.strip().split(' ')
+        if fields[0] == 'DIR':
+            download_dir = fields[1]
+        elif len(fields) == 4:
+            debs.append({'sha256': fields[0], 'package': fields[1], 'version': fields[2], 'file': fields[3]})
+
+    # Only what a previous build put there
+    for f in os.listdir(bundle_dir):
+        if f.endswith('.deb') or f in (BUNDLE_MANIFEST, BUNDLE_CHECKSUMS):
+            os.remove(path.join(bundle_dir, f))
+    if seed_host:
+        with settings(host_string=seed_host):
+            get(path.join(download_dir, '*.deb'), bundle_dir)
+            run('rm -rf %s' % download_dir, quiet=True)
+    else:
+        local('mv %s/*.deb %s && rmdir %s' % (download_dir, bundle_dir, download_dir))
+
+    with open(path.join(bundle_dir, BUNDLE_CHECKSUMS), 'w') as f:
+        f.writelines(["%s  %s\n" % (deb['sha256'], deb['file']) for deb in debs])
+    with open(path.join(bundle_dir, BUNDLE_MANIFEST), 'w') as f:
+        json.dump({'requested': list(packages), 'built': time.strftime("%Y-%m-%dT%H:%M:%S"), 'debs': debs}, f, indent=2)
+    info("Built package bundle %s with %d .debs" % (bundle_dir, len(debs)))
+    return bundle_dir
+
+def read_bundle_manifest(bundle_dir):
+    """Returns the parsed bundle.lock of bundle_dir, or None if there is no complete bundle there."""
+    manifest_path = path.join(bundle_dir, BUNDLE_MANIFEST)
+    if not path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if not all([path.exists(path.join(bundle_dir, deb['file'])) for deb in manifest['debs']]):
+        return None
+    return manifest
+
+@applied_step(inputs=lambda bundle_dir: read_bundle_manifest(bundle_dir))
+def install_bundle(bundle_dir):
+    """Pushes the bundle to the current host (skipping .debs it already holds), verifies checksums and installs every
+    package in it with dpkg. No mirror is contacted."""
+    manifest = read_bundle_manifest(bundle_dir)
+    if not manifest:
+        raise RuntimeError("No complete package bundle in %s; run build_bundle first." % bundle_dir)
+    remote_dir = path.join(REMOTE_BUNDLE_PARENT, path.basename(path.normpath(bundle_dir)))
+    sudo('mkdir -p %s' % remote_dir)
+
+    present = run('cd %s && sha256sum *.deb 2>/dev/null || true' % remote_dir, quiet=True)
+    present = set([tuple(line.split()) for line in present.splitlines() if line.strip()])
+    missing = [deb for deb in manifest['debs'] if (deb['sha256'], deb['file']) not in present]
+    debug("Pushing %d of %d .debs from bundle %s" % (len(missing), len(manifest['debs']), bundle_dir))
+    for deb in missing:
+        put(path.join(bundle_dir, deb['file']), remote_dir, use_sudo=True)
+    put(path.join(bundle_dir, BUNDLE_CHECKSUMS), remote_dir, use_sudo=True)
+
+    sudo('cd %s && sha256sum --check --quiet %s' % (remote_dir, BUNDLE_CHECKSUMS))
+    info("Installing %s from bundle (offline)" % " ".join(manifest['requested']))
+    sudo('DEBIAN_FRONTEND=noninteractive dpkg --install --skip-same-version --force-confdef --force-confnew %s/*.deb' % remote_dir)
@@ -0,0 +1,108 @@
+"""
+Runs a helper (e.g. install_packages, install_datadog_agent, stageflip functions) on every node in the current node set
+using a bounded pool of workers, without each caller having to decorate tasks with Fabric's @parallel.
+
+Each host runs in its own worker process (Fabric's parallel mode forks per host), so changes a helper makes to env -
+including use()/use_only() and env.nodes - are confined to that host. Failures are isolated too: a host that fails is
+retried on its own and then reported, while the remaining hosts carry on.
+
+Usage:
+    results = run_on_nodes(install_packages, 'nginx', 'ntp', pool_size=20, tries=3)
+    use_only(*[node for node in env.nodes if host_string(node) in results.succeeded()])
+"""
+from fabric.api import env, execute, parallel
+from . import error, info, warn
+from .cloud import current_node, host_string
+import time
+
+DEFAULT_POOL_SIZE = 10
+
+class HostContext(object):
+    """Per-host state for a helper invoked via run_on_nodes. Created inside the host's worker, so nothing stored here
+    (or in env) is visible to other hosts."""
+    def __init__(self, host, node, attempt):
+        self.host = host
+        self.node = node
+        self.attempt = attempt
+        self.data = {}
+
+    def __str__(self):
+        return "<HostContext %s attempt %d>" % (self.host, self.attempt)
+
+class HostResult(object):
+    """Outcome of running a helper on a single host. Returned from worker processes, so must stay picklable."""
+    def __init__(self, host, succeeded, value = None, error = None, attempts = 1, seconds = 0):
+        self.host = host
+        self.succeeded = succeeded
+        self.value = value
+        self.error = error
+        self.attempts = attempts
+        self.seconds = seconds
+
+    def __str__(self):
+        if self.succeeded:
+            return "%s: succeeded after %d attempt(s) in %.1fs" % (self.host, self.attempts, self.seconds)
+        return "%s: failed after %d attempt(s) in %.1fs: %s" % (self.host, self.attempts, self.seconds, self.error)
+
+class Results(dict):
+    """Dict of host string -> HostResult."""
+    def succeeded(self):
+        return [host for host, result in self.iteritems() if result.succeeded]
+
+    def failed(self):
+        return [host for host, result in self.iteritems() if not result.succeeded]
+
+    def values_by_host(self):
+        return dict([(host, result.value) for host, result in self.iteritems() if result.succeeded])
+
+def host_context():
+    """Returns the HostContext of the helper currently running under run_on_nodes, or None outside of it."""
+    return env.get('host_context')
+
+def run_on_nodes(helper, *args, **kwargs):
+    """Runs helper(*args, **kwargs) on each node, at most pool_size hosts at a time, and returns Results.
+    Keyword arguments consumed by run_on_nodes itself:
+    :param nodes: nodes to run on; defaults to env.nodes
+    :param pool_size: max concurrent hosts; defaults to env.executor_pool_size or 10
+    :param tries: attempts per host before giving up on it; defaults to env.executor_tries or 1
+    :param retry_delay_seconds: sleep between attempts on the same host; defaults to 5
+    :param with_context: if True, helper is invoked as helper(context, *args, **kwargs)
+    """
+    nodes = kwargs.pop('nodes', None)
+    nodes = env.nodes if nodes is None else nodes # Explicit None check because [] is False
+    pool_size = int(kwargs.pop('pool_size', None) or env.get('executor_pool_size', DEFAULT_POOL_SIZE))
+    tries = int(kwargs.pop('tries', None) or env.get('executor_tries', 1))
+    retry_delay_seconds = kwargs.pop('retry_delay_seconds', 5)
+    with_context = kwargs.pop('with_context', False)
+    name = getattr(helper, '__name__', str(helper))
+
+    hosts = [host_string(node) for node in nodes]
+    if not hosts:
+        info("No nodes to run %s on." % name)
+        return Results()
+
+    @parallel(pool_size=pool_size)
+    def _run_on_host_():
+        start = time.time()
+        last_error = None
+        for attempt in range(1, tries + 1):
+            context = HostContext(env.host_string, current_node(), attempt)
+            env.host_context = context
+            try:
+                value = helper(context, *args, **kwargs) if with_context else helper(*args, **kwargs)
+                return HostResult(env.host_string, True, value=value, attempts=attempt, seconds=time.time() - start)
+            except (Exception, SystemExit), e:
+                # Fabric reports remote command failures by raising SystemExit
+                last_error = "%s: %s" % (type(e).__name__, e)
+                if attempt < tries:
+                    warn("%s failed (%s); retrying this host in %d seconds..." % (name, last_error, retry_delay_seconds))
+                    time.sleep(retry_delay_seconds)
+        return HostResult(env.host_string, False, error=last_error, attempts=tries, seconds=time.time() - start)
+    _run_on_host_.__name__ = name
+
+    info("Running %s on %d host(s), %d at a time." % (name, len(hosts), pool_size))
+    results = Results(execute(_run_on_host_, hosts=hosts))
+    for host in results.failed():
+        error(str(results[host]))
+    info("%s finished: %d succeeded, %d failed." % (name, len(results.succeeded()), len(results.failed())))
+    return results
@@ -1,5 +1,59 @@
 from subprocess import check_output
+from os import path
+import os
+
+_shas_ = {} # git directory -> SHA of HEAD, so each run reads the repository at most once
 
 def get_sha():
-    """Determines Git SHA of current working directory."""
+    """Determines Git SHA of current working directory.
+    Reads HEAD and refs directly from the .git directory rather than spawning git; memoized for the rest of the run."""
+    git_dir = _find_git_dir_(os.getcwd())
+    if git_dir is None:
+        return _get_sha_via_git_()
+    if git_dir not in _shas_:
+        _shas_[git_dir] = _read_head_(git_dir) or _get_sha_via_git_()
+    return _shas_[git_dir]
+
+def _get_sha_via_git_():
     return check_output(["git", "log","-n1","--pretty=oneline"]).split(' ')[0]
+
+def _find_git_dir_(directory):
+    "Walks up from directory to find the repository's git directory, following 'gitdir:' files used by worktrees."
+    while True:
+        candidate = path.join(directory, '.git')
+        if path.isdir(candidate):
+            return candidate
+        if path.isfile(candidate):
+            content = _read_(candidate)
+            if content.startswith('gitdir:'):
+                return path.normpath(path.join(directory, content[len('gitdir:'):].strip()))
+        parent = path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+def _read_head_(git_dir):
+    "Returns SHA that HEAD points to, or None if it cannot be determined without git itself."
+    head = _read_(path.join(git_dir, 'HEAD'))
+    if not head.startswith('ref:'):
+        return head or None # detached HEAD
+    ref = head[len('ref:'):].strip()
+    # Worktrees keep HEAD locally but share refs with the main repository
+    common_dir = git_dir
+    if path.isfile(path.join(git_dir, 'commondir')):
+        common_dir = path.normpath(path.join(git_dir, _read_(path.join(git_dir, 'commondir'))))
+    for directory in (git_dir, common_dir):
+        sha = _read_(path.join(directory, ref))
+        if sha:
+            return sha
+    for line in _read_(path.join(common_dir, 'packed-refs')).splitlines():
+        fields = line.split(' ')
+        if len(fields) == 2 and fields[1] == ref:
+            return fields[0]
+    return None
+
+def _read_(file_path):
+    if not path.isfile(file_path):
+        return ''
+    with open(file_path) as f:
+        return f.read().strip()
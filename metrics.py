@@ -0,0 +1,36 @@
+"""
+Pluggable sources for a single numeric load metric, e.g. to drive autoscaling. A source is given as a string:
+    datadog:<query>     mean over the last metric_window_seconds (default 300) of a Datadog query, e.g.
+                        datadog:avg:system.load.1{role:web}
+    file:<path>         a number read from a local file
+    http(s)://<url>     a number served by an HTTP endpoint, either as the whole body or as the "value" field of a
+                        JSON object
+or as a function taking no arguments and returning a number.
+"""
+from fabric.api import env
+from . import debug
+import json
+import urllib2
+
+def read_metric(source):
+    """Returns the current value of the metric at source (see above), as a float, or None if it has no value."""
+    if callable(source):
+        value = source()
+    elif source.startswith('datadog:'):
+        from .datadog import query_metric
+        value = query_metric(source[len('datadog:'):], int(env.get('metric_window_seconds', 300)))
+    elif source.startswith('file:'):
+        with open(source[len('file:'):]) as f:
+            value = _parse_(f.read())
+    elif source.startswith('http://') or source.startswith('https://'):
+        value = _parse_(urllib2.urlopen(source, timeout=30).read())
+    else:
+        raise ValueError("Unsupported metric source '%s'" % source)
+    debug("Metric %s = %s" % (getattr(source, '__name__', source), value))
+    return None if value is None else float(value)
+
+def _parse_(text):
+    text = text.strip()
+    if text.startswith('{'):
+        return json.loads(text).get('value')
+    return float(text) if text else None
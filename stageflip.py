@@ -1,23 +1,199 @@
 """
-Helper functions for pushing content to a staging directory, moving the old directory aside, and moving the staging directory into place.
+Helpers for pushing content to a staging directory and atomically switching the active release over to it.
+
+Releases live side by side in <parent>/<basename>.releases/<timestamp>, and <parent>/<basename> is a symlink to the
+active one. flip re-points the symlink atomically and prunes all but the newest env.stageflip_keep_releases releases
+(default 5, at least 1); rollback re-points it to the previous release. Each is a single remote call. A pre-existing
+plain active directory is adopted as the oldest release on the first flip.
+
+If flip is given the artifact digest (see fabulous.artifact), it is stamped into the directory so that later deploys of
+the same build can skip hosts already running it, e.g.:
+    digest = artifact.digest_of('build/')
+    use_only(*nodes_needing_deploy(digest))
+Once a deploy completes, record_release() tags the nodes with the release via the provider API, so the version each
+node runs shows up in the inventory (e.g. the list task) without connecting to it.
+
+Rather than each host staging and flipping on its own as Fabric reaches it, synchronized_deploy() stages every host in
+parallel, then flips them all at once, so the fleet runs mixed versions only for the spread of a single remote command:
+    synchronized_deploy(lambda staging_dir: put('build/*', staging_dir), 'myapp', digest=digest)
+If any host fails to stage or flip, no host is left on the new release.
 """
-from fabric.api import env
+from fabric.api import env, run
 from fabric.operations import sudo
-from . import debug
+from . import debug, error, git, info, warn
+from .cloud import host_string, tag_deployed_version
+from .executor import run_on_nodes
+from multiprocessing import Event, Value
 from os import path
 import time
-import re
 
-def make_staging_directory(basename = "project", parent = "/opt"):
-    dir_tmp = path.join(parent,basename) + time.strftime("_%Y%m%d_%H%M%S") + ".deploying"
+DIGEST_FILE = '.fabulous-artifact'
+DEFAULT_KEEP_RELEASES = 5
+DEFAULT_FLIP_BARRIER_SECONDS = 60
+STAGING_SUFFIX = '.deploying'
+RELEASES_SUFFIX = '.releases'
+LEGACY_RELEASE = '00000000_000000_legacy' # sorts before any timestamped release
+
+_FLIP_SCRIPT_ = """set -e
+cd %(releases_dir)s
+mv %(staging)s %(release)s
+%(stamp)s
+if [ -d %(active_dir)s ] && [ ! -L %(active_dir)s ]; then mv %(active_dir)s %(legacy)s; fi
+ln -sfn %(releases_dir)s/%(release)s %(active_dir)s.flipping
+mv -T %(active_dir)s.flipping %(active_dir)s
+%(prune)s
+"""
+
+_PRUNE_SCRIPT_ = """ls -1 | grep -v '\\%(staging_suffix)s$' | sort | head -n -%(keep)d | xargs -r rm -rf
+find . -maxdepth 1 -name '*%(staging_suffix)s' -mmin +1440 -exec rm -rf {} +"""
+
+_ROLLBACK_SCRIPT_ = """set -e
+cd %(releases_dir)s
+current=$(basename $(readlink %(active_dir)s))
+previous=$(ls -1 | grep -v '\\%(staging_suffix)s$' | sort | awk -v current=$current '$0 == current {print previous; exit} {previous = $0}')
+if [ -z "$previous" ]; then echo "No release older than $current to roll back to" >&2; exit 1; fi
+ln -sfn %(releases_dir)s/$previous %(active_dir)s.flipping
+mv -T %(active_dir)s.flipping %(active_dir)s
+echo $previous
+"""
+
+def releases_directory(basename = "project", parent = "/opt"):
+    return path.join(parent, basename) + RELEASES_SUFFIX
+
+def make_staging_directory(basename = "project", parent = "/opt", release = None):
+    """Creates and returns a staging directory for a new release, named release (default the current timestamp)."""
+    dir_tmp = path.join(releases_directory(basename, parent), release or time.strftime("%Y%m%d_%H%M%S")) + STAGING_SUFFIX
     sudo('mkdir -p %s' % dir_tmp)
     sudo("chown %s:%s %s" % (env.user, env.group, dir_tmp))
     return dir_tmp
 
-def flip(staging_dir):
-    active_dir = re.sub(r'_[0-9]{8}_[0-9]{6}.deploying','',staging_dir)
-    retired_dir = active_dir + time.strftime("_%Y%m%d_%H%M%S") + ".retired"
-    debug("Flipping directory name.")
-    sudo("mv %s %s.retired" % (active_dir,retired_dir), quiet=True)
-    sudo("mv %s %s" % (staging_dir,active_dir))
+def flip(staging_dir, digest = None, prune = True):
+    """Makes staging_dir the active release by atomically re-pointing the active symlink, then prunes old releases
+    unless prune is False (see prune_releases). Returns the active directory (the symlink)."""
+    releases_dir = path.dirname(staging_dir)
+    active_dir = releases_dir[:-len(RELEASES_SUFFIX)]
+    release = path.basename(staging_dir)[:-len(STAGING_SUFFIX)]
+    debug("Flipping %s to release %s." % (active_dir, release))
+    sudo(_FLIP_SCRIPT_ % {
+        'releases_dir': releases_dir,
+        'active_dir': active_dir,
+        'staging': path.basename(staging_dir),
+        'release': release,
+        'stamp': "echo %s > %s" % (digest, path.join(release, DIGEST_FILE)) if digest else "",
+        'legacy': LEGACY_RELEASE,
+        'staging_suffix': STAGING_SUFFIX,
+        'prune': _prune_script_() if prune else ""
+    })
     return active_dir
+
+def prune_releases(basename = "project", parent = "/opt"):
+    """Removes all but the newest env.stageflip_keep_releases releases, and staging directories abandoned for a day."""
+    sudo("set -e\ncd %s\n%s" % (releases_directory(basename, parent), _prune_script_()))
+
+def _prune_script_():
+    # At least the active release is kept; head -n -0 would list every release for removal
+    keep = max(1, int(env.get('stageflip_keep_releases', DEFAULT_KEEP_RELEASES)))
+    return _PRUNE_SCRIPT_ % {'keep': keep, 'staging_suffix': STAGING_SUFFIX}
+
+def rollback(basename = "project", parent = "/opt"):
+    """Re-points the active symlink to the release preceding the active one. Returns the release now active.
+    Repeated rollbacks step further back, as far as retention allows."""
+    releases_dir = releases_directory(basename, parent)
+    previous = sudo(_ROLLBACK_SCRIPT_ % {
+        'releases_dir': releases_dir,
+        'active_dir': path.join(parent, basename),
+        'staging_suffix': STAGING_SUFFIX
+    }).strip()
+    info("Rolled %s back to release %s." % (path.join(parent, basename), previous))
+    return previous
+
+def list_releases(basename = "project", parent = "/opt"):
+    """Returns (releases oldest to newest, active release) on the current host."""
+    output = run("ls -1 %s | grep -v '\\%s$' | sort; basename $(readlink %s)" %
+                 (releases_directory(basename, parent), STAGING_SUFFIX, path.join(parent, basename)), quiet=True)
+    lines = [line.strip() for line in output.splitlines() if line.strip()]
+    return lines[:-1], (lines[-1] if lines else None)
+
+def deployed_digest(basename = "project", parent = "/opt"):
+    """Returns the artifact digest stamped into the current host's active directory, or None."""
+    digest = run("cat %s 2>/dev/null || true" % path.join(parent, basename, DIGEST_FILE), quiet=True).strip()
+    return digest or None
+
+def nodes_needing_deploy(digest, basename = "project", parent = "/opt", nodes = None):
+    """Returns those of nodes (default env.nodes) whose active directory is not stamped with digest.
+    Hosts are checked in parallel; hosts that cannot be checked are assumed to need the deploy."""
+    nodes = env.nodes if nodes is None else nodes # Explicit None check because [] is False
+    deployed = run_on_nodes(deployed_digest, basename, parent, nodes=nodes).values_by_host()
+    needing = [node for node in nodes if deployed.get(host_string(node)) != digest]
+    info("%d of %d node(s) need artifact %s; the rest already run it." % (len(needing), len(nodes), digest[:12]))
+    return needing
+
+def record_release(digest = None, nodes = None):
+    """Tags nodes (default env.nodes) with the Git SHA, the artifact digest and the deploy time, in one batched provider
+    call. Call once per deploy, after all hosts have flipped (e.g. from a @runs_once task)."""
+    tag_deployed_version(nodes, git.get_sha(), digest)
+
+def synchronized_deploy(stage, basename = "project", parent = "/opt", digest = None, nodes = None):
+    """Deploys a release to nodes (default env.nodes) in two phases:
+    1. every host creates the same staging directory and runs stage(staging_dir) to fill it, all in parallel
+    2. once all have staged, every host opens its session and waits at a barrier, then all flip at once
+    If any host fails to stage, the staging directories are removed and nothing is flipped; if any fails to flip, the
+    hosts that did flip are rolled back. Old releases are only pruned once every host has flipped, so rolling back
+    never finds its previous release gone. On success the release is recorded (see record_release).
+    Returns True if every node now runs the new release, otherwise False (and none does)."""
+    nodes = env.nodes if nodes is None else nodes # Explicit None check because [] is False
+    if not nodes:
+        info("No nodes to deploy to.")
+        return True
+    pool_size = int(env.get('stageflip_pool_size', 0)) or len(nodes)
+    release = time.strftime("%Y%m%d_%H%M%S")
+    staging_dir = path.join(releases_directory(basename, parent), release) + STAGING_SUFFIX
+
+    staged = run_on_nodes(_stage_release_, stage, basename, parent, release, nodes=nodes, pool_size=pool_size)
+    if staged.failed():
+        error("%d of %d host(s) failed to stage release %s; discarding it everywhere." % (len(staged.failed()), len(nodes), release))
+        run_on_nodes(_discard_release_, basename, parent, release, nodes=nodes, pool_size=pool_size)
+        return False
+
+    # Every host must reach the barrier at once, so all of them need a worker
+    arrived = Value('i', 0)
+    all_arrived = Event()
+    flipped = run_on_nodes(_flip_in_unison_, staging_dir, digest, len(nodes), arrived, all_arrived,
+                           nodes=nodes, pool_size=len(nodes), tries=1)
+    if flipped.failed():
+        error("%d of %d host(s) failed to flip to release %s; rolling all hosts back." % (len(flipped.failed()), len(nodes), release))
+        run_on_nodes(_discard_release_, basename, parent, release, nodes=nodes, pool_size=pool_size)
+        return False
+
+    flip_times = [flipped_at for active_dir, flipped_at in flipped.values_by_host().values()]
+    info("Flipped %d host(s) to release %s within %.2fs of each other." % (len(nodes), release, max(flip_times) - min(flip_times)))
+    pruned = run_on_nodes(prune_releases, basename, parent, nodes=nodes, pool_size=pool_size)
+    if pruned.failed():
+        warn("Could not prune old releases on %s; they will be pruned by the next deploy." % ", ".join(pruned.failed()))
+    record_release(digest, nodes)
+    return True
+
+def _stage_release_(stage, basename, parent, release):
+    staging_dir = make_staging_directory(basename, parent, release)
+    stage(staging_dir)
+    return staging_dir
+
+def _flip_in_unison_(staging_dir, digest, count, arrived, all_arrived):
+    # Open the session before the barrier, so that the flips themselves go out together
+    run("true", quiet=True)
+    with arrived.get_lock():
+        arrived.value += 1
+        if arrived.value == count:
+            all_arrived.set()
+    timeout = int(env.get('stageflip_barrier_seconds', DEFAULT_FLIP_BARRIER_SECONDS))
+    if not all_arrived.wait(timeout):
+        raise RuntimeError("Not every host was ready to flip within %ds; not flipping." % timeout)
+    # Pruning waits until every host has flipped, as a host that did may yet have to roll back
+    return flip(staging_dir, digest, prune=False), time.time()
+
+def _discard_release_(basename, parent, release):
+    """Undoes a partial synchronized_deploy on the current host: rolls back if release is active, then removes it."""
+    releases, active = list_releases(basename, parent)
+    if active == release:
+        rollback(basename, parent)
+    sudo("rm -rf %s %s" % tuple([path.join(releases_directory(basename, parent), release) + suffix for suffix in ('', STAGING_SUFFIX)]))
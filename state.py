@@ -0,0 +1,73 @@
+"""
+Per-host record of the fabulous steps already applied to a node, so that re-running a deploy against an unchanged node
+skips them.
+
+The manifest is a small JSON file on each host mapping step name -> fingerprint of the step's inputs. It is read once
+per host per run (a single remote call) and rewritten after each step that actually runs. Set force_refresh to true to
+re-run every step, or to a comma-separated list of step names to re-run only those, e.g.
+    fab --set force_refresh=install_packages,upgrade_system ...
+"""
+from fabric.api import env, put
+from fabric.operations import sudo
+from . import debug, fingerprint, warn
+from StringIO import StringIO
+from functools import wraps
+from os import path
+import json
+
+STATE_MANIFEST = '/var/lib/fabulous/state.json'
+
+_manifests_ = {} # host string -> {step name: fingerprint}
+
+def applied_state():
+    """Returns the current host's manifest of applied steps, reading it from the host on first use."""
+    key = env.host_string
+    if key not in _manifests_:
+        content = sudo('cat %s 2>/dev/null || true' % STATE_MANIFEST, quiet=True)
+        try:
+            _manifests_[key] = json.loads(content) if content.strip() else {}
+        except ValueError:
+            warn("Ignoring unreadable state manifest %s" % STATE_MANIFEST)
+            _manifests_[key] = {}
+    return _manifests_[key]
+
+def forget_applied_state(*steps):
+    """Removes the named steps (all steps if none named) from the current host's manifest, so they run again."""
+    manifest = applied_state()
+    for step in (steps or manifest.keys()):
+        manifest.pop(step, None)
+    _write_(manifest)
+
+def is_forced(step):
+    """Returns True if force_refresh requests that step be re-run regardless of the manifest."""
+    force_refresh = str(env.get('force_refresh') or '').lower()
+    if force_refresh in ("y","yes","t","true","1","on"):
+        return True
+    return step in [name.strip() for name in force_refresh.split(',')]
+
+def applied_step(name = None, inputs = None):
+    """Decorator that skips the decorated step on hosts whose manifest shows it was already applied with the same
+    arguments and inputs. Returns None when skipped.
+    :param name: step name recorded in the manifest; defaults to the function name
+    :param inputs: optional function called with the step's arguments, returning any further JSON-serializable values
+        the step depends on (e.g. settings read from env, or the node's name for steps that are per instance)
+    """
+    def deco_applied_step(f):
+        step = name or f.__name__
+        @wraps(f)
+        def f_applied_step(*args, **kwargs):
+            step_fingerprint = fingerprint(step, args, kwargs, inputs(*args, **kwargs) if inputs else None)
+            if applied_state().get(step) == step_fingerprint and not is_forced(step):
+                debug("Skipping %s; already applied with the same inputs." % step)
+                return None
+            result = f(*args, **kwargs)
+            manifest = applied_state()
+            manifest[step] = step_fingerprint
+            _write_(manifest)
+            return result
+        return f_applied_step
+    return deco_applied_step
+
+def _write_(manifest):
+    sudo('mkdir -p %s' % path.dirname(STATE_MANIFEST), quiet=True)
+    put(StringIO(json.dumps(manifest, indent=2, sort_keys=True)), STATE_MANIFEST, use_sudo=True)